@@ -1,3 +1,3 @@
 from .matrix_server import MatrixServer, MatrixClient
-from .matrix_graphics import MatrixGraphics
+from .matrix_graphics import MatrixBitmap, MatrixGraphics
 from .matrix_controller import MatrixController, MatrixError
\ No newline at end of file
@@ -21,8 +21,54 @@ This file contains the classes needed to address the matrix controller board in
 """
 
 import serial
+import threading
 import time
 
+from collections import deque
+
+# The largest bitmap the controller accepts, in blocks
+MAX_BLOCK_COUNT = 100
+
+# The message count of a datagram is a single byte
+MAX_MESSAGES_PER_DATAGRAM = 255
+
+# The smallest chunk automatic tuning will go down to
+MIN_CHUNK_SIZE = 8
+
+# The controller gives up on a datagram if no data arrives for this many seconds
+SERIAL_READ_TIMEOUT = 1.0
+
+# The longest pause between chunks
+MAX_CHUNK_DELAY = 0.25
+
+# The default time to wait for a response. With automatic tuning, it has to be longer than SERIAL_READ_TIMEOUT,
+# otherwise the controller's response to lost data arrives too late to be noticed.
+DEFAULT_TIMEOUT = 0.5
+DEFAULT_TUNING_TIMEOUT = SERIAL_READ_TIMEOUT + 0.5
+
+# The pause between chunks is the time it takes to transmit a chunk plus a margin, which automatic tuning
+# adjusts in steps of at least this many seconds
+CHUNK_MARGIN_STEP = 0.002
+
+# Automatic tuning looks at this many transmissions when deciding whether to back off
+TUNING_WINDOW = 20
+
+# Try going faster after this many transmissions in a row without flow control errors.
+# Every time changing a setting to go faster fails, the next try for that setting waits twice as long, up to MAX_PROBE_WINDOW.
+PROBE_WINDOW = 8
+MAX_PROBE_WINDOW = 256
+
+# Back off if more than this fraction of transmissions failed because the controller couldn't keep up
+MAX_ERROR_RATE = 0.1
+
+# Error codes that are caused by the controller's receive buffer overflowing.
+# Missing responses (-225) don't count: a display that is unplugged or switched off never responds, and slowing down
+# for it would hold up the whole bus. Lost data is reported as error 2 within DEFAULT_TUNING_TIMEOUT.
+FLOW_CONTROL_ERRORS = (2, 3)
+
+# Upper bounds (in milliseconds) of the buckets of the acknowledgement latency histogram
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
 class MatrixError(Exception):
     ERR_CODES = {
         -225: "Controller is not responding",
@@ -48,34 +94,239 @@ class MatrixError(Exception):
     def __str__(self):
         return "%i: %s" % (self.code, self.description)
 
+class FlowControl(object):
+    """
+    How a controller is sent data: in chunks of chunk_size bytes with a pause of chunk_delay seconds in between.
+    """
+    
+    def __init__(self, address, chunk_size, chunk_delay, byte_time, serial_buffer_size, debug = False):
+        self.address = address
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.byte_time = byte_time
+        self.serial_buffer_size = serial_buffer_size
+        self.debug = debug
+        # How much longer than its transmission time the pause after a chunk is
+        self.chunk_margin = max(0.0, chunk_delay - byte_time * chunk_size) if chunk_size else 0.0
+        # Whether each of the last transmissions failed because of a flow control error
+        self.tuning_results = deque(maxlen = TUNING_WINDOW)
+        # Transmissions in a row without flow control errors since the settings were last changed
+        self.clean_streak = 0
+        # Automatic tuning changes one setting at a time, taking turns between chunk size and margin
+        self.tune_margin_next = False
+        # How long to wait before trying to go faster by changing the chunk size or the margin, by whether it's the margin
+        self.probe_windows = [PROBE_WINDOW, PROBE_WINDOW]
+        # The settings before the last attempt to go faster, as long as it hasn't proven to work, and which setting was changed
+        self.probed_from = None
+        self.probed_margin = False
+    
+    def tune(self, flow_error):
+        """
+        Adjust chunk size and margin after a transmission. Only one of them is changed at a time, so a single error
+        doesn't slow transmission down more than necessary, and the pause always follows the chunk size.
+        """
+        
+        self.tuning_results.append(flow_error)
+        self.clean_streak = 0 if flow_error else self.clean_streak + 1
+        error_rate = sum(self.tuning_results) / len(self.tuning_results)
+        can_grow_margin = self.chunk_margin < MAX_CHUNK_DELAY
+        can_shrink_chunks = self.chunk_size > MIN_CHUNK_SIZE
+        can_shrink_margin = self.chunk_margin > 0
+        can_grow_chunks = self.chunk_size < self.serial_buffer_size
+        probe_margin = can_shrink_margin and (self.tune_margin_next or not can_grow_chunks)
+        if flow_error and self.probed_from is not None:
+            # Going faster didn't work, go back and don't try this again as soon
+            self.chunk_size, self.chunk_margin, self.tune_margin_next = self.probed_from
+            self.probe_windows[self.probed_margin] = min(MAX_PROBE_WINDOW, self.probe_windows[self.probed_margin] * 2)
+            self.probed_from = None
+        elif flow_error and error_rate > MAX_ERROR_RATE and (can_grow_margin or can_shrink_chunks):
+            # Back off: send less at once or wait longer in between
+            if can_grow_margin and (self.tune_margin_next or not can_shrink_chunks):
+                self.chunk_margin = min(MAX_CHUNK_DELAY, max(CHUNK_MARGIN_STEP, self.chunk_margin * 2))
+            else:
+                self.chunk_size = max(MIN_CHUNK_SIZE, self.chunk_size // 2)
+        elif self.probed_from is not None and self.clean_streak >= PROBE_WINDOW:
+            # The new settings work
+            self.probed_from = None
+            self.probe_windows[self.probed_margin] = max(PROBE_WINDOW, self.probe_windows[self.probed_margin] // 2)
+            return
+        elif self.clean_streak >= self.probe_windows[probe_margin] and (can_shrink_margin or can_grow_chunks):
+            # No trouble for a while, try going faster again
+            self.probed_from = (self.chunk_size, self.chunk_margin, self.tune_margin_next)
+            self.probed_margin = probe_margin
+            if probe_margin:
+                self.chunk_margin = self.chunk_margin * 0.75 if self.chunk_margin > CHUNK_MARGIN_STEP else 0.0
+            else:
+                self.chunk_size = min(self.serial_buffer_size, self.chunk_size + max(MIN_CHUNK_SIZE // 2, self.chunk_size // 4))
+        else:
+            return
+        
+        self.tune_margin_next = not self.tune_margin_next
+        self.chunk_delay = min(MAX_CHUNK_DELAY, self.byte_time * self.chunk_size + self.chunk_margin)
+        self.tuning_results.clear()
+        self.clean_streak = 0
+        if self.debug:
+            print("Flow control for address %s: %i byte chunks, %.1f ms between chunks" % (self.address, self.chunk_size, self.chunk_delay * 1000))
+
 class MatrixController(object):
-    def __init__(self, port, baudrate = 115200, timeout = 0.5, num_blocks = 15, max_tries = 3, retry_delay = 0.0, serial_buffer_size = 256, debug = False):
+    def __init__(self, port, baudrate = 115200, timeout = None, num_blocks = 15, max_tries = 3, retry_delay = 0.05, max_retry_delay = 1.0,
+                 serial_buffer_size = 256, chunk_size = None, chunk_delay = None, auto_tune = True, debug = False):
+        """
+        Datagrams are written in chunks of chunk_size bytes with a pause of chunk_delay seconds in between,
+        so the controller's receive buffer of serial_buffer_size bytes doesn't overflow.
+        With auto_tune, both are adjusted according to how often the controller reports that it couldn't keep up,
+        starting from the given values (by default a full buffer at the speed of the serial line).
+        Each multiplexer address is tuned separately, see select_address. Only error responses count, not missing ones, since
+        a display that is switched off doesn't respond at all. The controller reports lost data after SERIAL_READ_TIMEOUT seconds
+        without input, so timeout defaults to DEFAULT_TUNING_TIMEOUT with auto_tune and to DEFAULT_TIMEOUT without it.
+        Without auto_tune, chunk_size = None sends the whole datagram at once.
+        """
+        
+        if port.startswith("annax://"):
+            # Importing the simulator registers the URL with pyserial. It's only needed for testing, so it isn't imported otherwise.
+            from . import matrix_simulator
+        if timeout is None:
+            timeout = DEFAULT_TUNING_TIMEOUT if auto_tune else DEFAULT_TIMEOUT
         self.port = serial.serial_for_url(port, baudrate = baudrate, timeout = timeout)
         self.num_blocks = num_blocks
         self.max_tries = max_tries
         self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
         self.serial_buffer_size = serial_buffer_size
+        self.auto_tune = auto_tune
         self.debug = debug
         self.pending_messages = []
+        
+        # Time it takes to transmit one byte (8 data bits plus start and stop bit)
+        self.byte_time = 10.0 / baudrate
+        if chunk_size is None and auto_tune:
+            chunk_size = serial_buffer_size
+        if chunk_delay is None:
+            chunk_delay = self.byte_time * chunk_size if chunk_size else 0.0
+        self.initial_chunk_size = chunk_size
+        self.initial_chunk_delay = chunk_delay
+        # Every display behind the multiplexer has its own controller, so each one is tuned separately, by address
+        self.flow_controls = {}
+        self.select_address(None)
+        
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+    
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = self._empty_stats()
+    
+    def _empty_stats(self):
+        return {
+            'since': time.time(),
+            # Datagrams that were acknowledged, or given up on after max_tries attempts
+            'datagrams_sent': 0,
+            'datagrams_failed': 0,
+            'attempts': 0,
+            'retries': 0,
+            # Including retransmissions
+            'bytes_sent': 0,
+            # Attempts that got no response at all
+            'timeouts': 0,
+            # Failed attempts by error code (see MatrixError.ERR_CODES)
+            'errors': {},
+            # Seconds spent writing datagrams and waiting for the response
+            'io_time': 0.0,
+            # Time between the last byte being written and the response arriving
+            'ack_latency_total': 0.0,
+            'ack_latency_max': 0.0,
+            'ack_latency_histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+        }
+    
+    def get_stats(self, reset = False):
+        """
+        Return a copy of the transmission statistics along with some figures derived from them.
+        The last bucket of the histogram counts everything slower than the last entry of LATENCY_BUCKETS.
+        """
+        
+        with self.stats_lock:
+            stats = dict(self.stats)
+            stats['errors'] = dict(stats['errors'])
+            stats['ack_latency_histogram'] = list(stats['ack_latency_histogram'])
+            if reset:
+                # Within the lock so nothing recorded in between gets lost
+                self.stats = self._empty_stats()
+        
+        responses = stats['attempts'] - stats['timeouts']
+        stats['ack_latency_mean'] = stats['ack_latency_total'] / responses if responses else None
+        stats['ack_latency_buckets'] = list(LATENCY_BUCKETS)
+        stats['bytes_per_second'] = stats['bytes_sent'] / stats['io_time'] if stats['io_time'] else None
+        return stats
+    
+    def record_attempt(self, num_bytes, io_time, ack_latency, error_code):
+        with self.stats_lock:
+            stats = self.stats
+            stats['attempts'] += 1
+            stats['bytes_sent'] += num_bytes
+            stats['io_time'] += io_time
+            if ack_latency is None:
+                stats['timeouts'] += 1
+            else:
+                stats['ack_latency_total'] += ack_latency
+                stats['ack_latency_max'] = max(stats['ack_latency_max'], ack_latency)
+                bucket = 0
+                while bucket < len(LATENCY_BUCKETS) and ack_latency * 1000 > LATENCY_BUCKETS[bucket]:
+                    bucket += 1
+                stats['ack_latency_histogram'][bucket] += 1
+            if error_code is not None:
+                stats['errors'][error_code] = stats['errors'].get(error_code, 0) + 1
+    
+    def record_datagram(self, success, num_tries):
+        with self.stats_lock:
+            if success:
+                self.stats['datagrams_sent'] += 1
+            else:
+                self.stats['datagrams_failed'] += 1
+            self.stats['retries'] += num_tries - 1
+    
+    def get_flow_control(self, address):
+        flow_control = self.flow_controls.get(address)
+        if flow_control is None:
+            # setdefault, so another thread asking at the same time gets the same one
+            flow_control = self.flow_controls.setdefault(address, FlowControl(address, self.initial_chunk_size, self.initial_chunk_delay,
+                                                                              self.byte_time, self.serial_buffer_size, self.debug))
+        return flow_control
+    
+    def select_address(self, address):
+        # Use the flow control settings of the display at this multiplexer address from now on
+        self.flow_control = self.get_flow_control(address)
+    
+    @property
+    def chunk_size(self):
+        return self.flow_control.chunk_size
+    
+    @property
+    def chunk_delay(self):
+        return self.flow_control.chunk_delay
     
     def send_raw_datagram(self, datagram):
         num_tries = 0
         success = False
         while num_tries < self.max_tries and not success:
             if num_tries > 0:
-                time.sleep(self.retry_delay)
+                # Back off exponentially and throw away whatever the controller said about the failed attempt
+                time.sleep(min(self.max_retry_delay, self.retry_delay * 2 ** (num_tries - 1)))
+                self.port.reset_input_buffer()
             
-            chunk_size = 9999999#int(self.serial_buffer_size / 2)
+            chunk_size = self.chunk_size or len(datagram)
+            write_start = time.time()
             pos = 0
             while pos < len(datagram):
                 self.port.write(datagram[pos:pos + chunk_size])
                 if self.debug:
                     print("[%i:%i]" % (pos, pos + chunk_size), " ".join([hex(byte)[2:].upper().rjust(2, "0") for byte in datagram[pos:pos + chunk_size]]))
                 pos += chunk_size
-                if pos < len(datagram):
-                    time.sleep(0)#.05)
+                if pos < len(datagram) and self.chunk_delay:
+                    time.sleep(self.chunk_delay)
             
+            write_end = time.time()
             response = self.port.read(1)
+            response_time = time.time()
             if response:
                 response = response[0]
                 if self.debug:
@@ -85,8 +336,16 @@ class MatrixController(object):
                 response = -1
                 success = False
             
+            self.record_attempt(len(datagram), response_time - write_start,
+                                response_time - write_end if response != -1 else None,
+                                None if success else response - 0xE0)
+            
+            if self.auto_tune:
+                self.flow_control.tune(not success and response - 0xE0 in FLOW_CONTROL_ERRORS)
+            
             num_tries += 1
         
+        self.record_datagram(success, num_tries)
         if not success:
             raise MatrixError(response = response)
         
@@ -95,37 +354,58 @@ class MatrixController(object):
     def clear_queue(self):
         self.pending_messages = []
     
+    def compact_queue(self):
+        # Only the last bitmap and the last value of each parameter have any effect, so drop everything else.
+        # Messages are identified by their action byte and stay in the order of their last occurrence.
+        latest = {}
+        for index, message in enumerate(self.pending_messages):
+            latest[message[0]] = index
+        
+        if self.debug and len(latest) < len(self.pending_messages):
+            print("Dropped %i superseded messages" % (len(self.pending_messages) - len(latest)))
+        self.pending_messages = [self.pending_messages[index] for index in sorted(latest.values())]
+    
     def commit(self):
         # Send all pending messages to the controller
         if not self.pending_messages:
             return False
         
-        datagram = bytearray()
-        datagram.append(0xFF)
-        datagram.append(len(self.pending_messages))
-        
-        for message in self.pending_messages:
-            datagram += message
-        
-        try:
+        self.compact_queue()
+        for start in range(0, len(self.pending_messages), MAX_MESSAGES_PER_DATAGRAM):
+            messages = self.pending_messages[start:start + MAX_MESSAGES_PER_DATAGRAM]
+            datagram = bytearray()
+            datagram.append(0xFF)
+            datagram.append(len(messages))
+            
+            for message in messages:
+                datagram += message
+            
             self.send_raw_datagram(datagram)
-        except:
-            raise
-        else:
-            self.clear_queue()
         
+        self.clear_queue()
         return True
     
-    def send_bitmap(self, bitmap):
+    def queue_message(self, message):
+        # Queue a message that has been built in advance, e.g. with build_bitmap_message
+        self.pending_messages.append(message)
+    
+    @staticmethod
+    def build_bitmap_message(bitmap):
+        # The controller would reject this anyway, but only after the whole datagram has been sent
+        if not 0 < len(bitmap) <= MAX_BLOCK_COUNT:
+            raise MatrixError(code = 1)
+        
         datagram = bytearray()
         datagram.append(0xA0)
         datagram.append(len(bitmap))
         
         for block in bitmap:
-            for byte in block:
-                datagram.append(byte)
+            datagram.extend(block)
         
-        self.pending_messages.append(datagram)
+        return bytes(datagram)
+    
+    def send_bitmap(self, bitmap):
+        self.queue_message(self.build_bitmap_message(bitmap))
     
     def set_parameter(self, code, value):
         """
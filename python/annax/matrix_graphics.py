@@ -21,13 +21,36 @@ This file contains utilities for generating text, graphics and other useful stuf
 the pure matrix controller functions.
 """
 
+import bisect
+import json
+import math
+import os
 import re
 import subprocess
+import threading
 
-from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 DEFAULT_FONT = "PixelMix"
 
+# Where fonts are usually installed; changes in these directories invalidate the font index
+FONT_DIRS = (
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts")
+)
+
+# The font index caches the output of fc-list between runs
+FONT_INDEX_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"), "annax", "font_index.json")
+FONT_INDEX_VERSION = 1
+
+# Lookup tables used to threshold a single channel: black stays off, anything else turns on
+PIXEL_TABLE_BILEVEL = [0] + [255] * 255
+PIXEL_TABLE_BINARY = [0] + [1] * 255
+
 # A few pre-compiled bitmaps with various patterns
 BITMAP_CHECKER = [
     [0, 1] * 60,
@@ -73,14 +96,448 @@ BITMAP_EMPTY = [
     [0] * 120
 ]
 
+# Time strings are split into single digits and runs of anything else, see MatrixGraphics.build_time_text
+TIME_STRING_SEGMENTS = re.compile(r"\d|\D+")
+
+# How many rendered segments to keep per MatrixGraphics instance
+GLYPH_CACHE_SIZE = 256
+
+# PIL moves all of a text up or down depending on which of its glyphs is the tallest, see MatrixGraphics._render_glyph_run.
+# Putting these in front of a glyph run makes them the tallest, so every run ends up on the same baseline.
+GLYPH_REFERENCE = "|\u00c5\u00c9"
+
+# Maps a column with the top row in the least significant bit to one with the top row in the most significant bit
+REVERSED_BITS = bytes(int("{:08b}".format(value)[::-1], 2) for value in range(256))
+
+# The ways build_text can render text: with PIL, or from a glyph atlas with proportional or fixed advance
+RENDERERS = ('pil', 'atlas', 'atlas-fixed')
+
+# The characters used to work out the cell width of fixed advance text
+ATLAS_CELL_CHARACTERS = "".join(chr(code) for code in range(0x20, 0x7F))
+
+# The effects MatrixAnimation.build knows
+ANIMATION_EFFECTS = ('slide-up', 'slide-down', 'wipe-left', 'wipe-right', 'blink', 'ticker')
+
+def threshold_image(image, mode = '1'):
+    """
+    Reduce an image to a single channel in one pass.
+    A pixel is on if any of its color channels is non-zero (the alpha channel is ignored).
+    mode '1' returns a bilevel image, mode 'L' returns a grayscale image containing only 0 and 1.
+    """
+    
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    
+    red, green, blue = image.convert('RGB').split()
+    brightest = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    if mode == '1':
+        return brightest.point(PIXEL_TABLE_BILEVEL, '1')
+    return brightest.point(PIXEL_TABLE_BINARY)
+
+def crop_rows(top, box_top, box_bottom, top_offset):
+    """
+    Work out which rows of text put together from glyph runs (see MatrixGraphics._render_glyph_run) would survive
+    MatrixGraphics._prepare_text, which draws text into an image as high as its box plus top_offset, with the box starting
+    top_offset rows down, and cuts off everything outside of it. That matters for fonts taller than the display.
+    top is the topmost row with ink, box_top and box_bottom are the top and bottom of the box of the whole text (see ImageFont.getbbox).
+    Returns a bit mask of the rows within the image.
+    """
+    
+    # The row that ends up at the top edge of the image
+    first = top - top_offset - box_top
+    rows = (1 << max(0, top_offset + box_bottom)) - 1
+    return rows << first if first >= 0 else rows >> -first
+
+def get_font_dir_mtimes(font_paths):
+    # Collect the modification times of the font directories and every directory that contains fonts
+    directories = set(FONT_DIRS)
+    for path in font_paths:
+        directory = os.path.dirname(path)
+        # Include the parents as well so fonts in new subdirectories are noticed
+        while directory and directory not in directories:
+            directories.add(directory)
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+    
+    mtimes = {}
+    for directory in directories:
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime
+        except OSError:
+            mtimes[directory] = None
+    return mtimes
+
+class MatrixBitmap(object):
+    """
+    A compact, immutable bitmap for the 8 pixel high matrix.
+    Pixels are stored column by column, one byte per column with the top row in the most significant bit,
+    so cropping, padding and concatenating are plain byte slicing.
+    The list-of-lists "long bitmap" form is only used at the JSON boundary (see from_long_bitmap and to_long_bitmap).
+    MatrixGraphics.build_text_bitmap, build_image_bitmap, align_bitmap and blend_bitmaps return a MatrixBitmap;
+    build_text, build_image, align_long_bitmap and blend_long_bitmaps return the same as a list of rows like they always did.
+    """
+    
+    __slots__ = ('width', 'height', 'columns', '_blocks')
+    
+    def __init__(self, width, height = 8, columns = None):
+        if not 0 <= height <= 8:
+            raise ValueError("Bitmap height must be between 0 and 8, got %i" % height)
+        
+        if columns is None:
+            columns = bytes(width)
+        elif len(columns) != width:
+            raise ValueError("Expected %i columns, got %i" % (width, len(columns)))
+        
+        self.width = width
+        self.height = height
+        self.columns = bytes(columns)
+        self._blocks = None
+    
+    def __eq__(self, other):
+        if not isinstance(other, MatrixBitmap):
+            return NotImplemented
+        return self.width == other.width and self.height == other.height and self.columns == other.columns
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+    
+    def __hash__(self):
+        return hash((self.width, self.height, self.columns))
+    
+    def __repr__(self):
+        return "<MatrixBitmap %ix%i>" % (self.width, self.height)
+    
+    @classmethod
+    def coerce(cls, bitmap):
+        # Accept either a MatrixBitmap or a long bitmap as received via JSON
+        if isinstance(bitmap, cls):
+            return bitmap
+        return cls.from_long_bitmap(bitmap)
+    
+    @classmethod
+    def from_long_bitmap(cls, long_bitmap):
+        height = len(long_bitmap)
+        width = len(long_bitmap[0]) if height else 0
+        columns = bytearray(width)
+        for y, row in enumerate(long_bitmap):
+            bit = 0x80 >> y
+            for x, pixel in enumerate(row[:width]):
+                if pixel:
+                    columns[x] |= bit
+        return cls(width, height, columns)
+    
+    @classmethod
+    def from_image(cls, image):
+        # Black pixels are off, pixels of any other color are on
+        bilevel = threshold_image(image)
+        width, height = bilevel.size
+        if width == 0 or height == 0:
+            return cls(width, height)
+        # Transposed, every row of the bilevel image is one packed column byte
+        return cls(width, height, bilevel.transpose(Image.TRANSPOSE).tobytes())
+    
+    def to_long_bitmap(self):
+        return [[(column >> (7 - y)) & 1 for column in self.columns] for y in range(self.height)]
+    
+    def blocks(self):
+        """
+        Return the bitmap in the controller's block format: one bytes object per 8 columns,
+        containing one byte per row with the leftmost pixel in the most significant bit.
+        The controller always expects 8 rows per block, rows below the height of the bitmap are blank.
+        """
+        
+        if self._blocks is None:
+            if self.width == 0:
+                self._blocks = []
+            else:
+                # Let PIL do the bit transposition from columns to rows
+                rows = Image.frombytes('1', (8, self.width), self.columns).transpose(Image.TRANSPOSE).tobytes()
+                stride = (self.width + 7) // 8
+                self._blocks = [rows[block::stride] for block in range(stride)]
+        return self._blocks
+    
+    def pack(self):
+        return b"".join(self.blocks())
+    
+    def to_short_bitmap(self):
+        return [list(block) for block in self.blocks()]
+    
+    def crop(self, left, width):
+        left = max(0, left)
+        columns = self.columns[left:left + width]
+        return MatrixBitmap(len(columns), self.height, columns)
+    
+    def pad(self, left = 0, right = 0):
+        return MatrixBitmap(self.width + left + right, self.height, bytes(left) + self.columns + bytes(right))
+    
+    def shift(self, rows):
+        # Move the content down by the given number of rows (up if negative), rows moved out are lost
+        mask = (0xFF << (8 - self.height)) & 0xFF
+        if rows >= 0:
+            table = bytes(((value >> rows) & mask) for value in range(256))
+        else:
+            table = bytes(((value << -rows) & mask) for value in range(256))
+        return MatrixBitmap(self.width, self.height, self.columns.translate(table))
+    
+    def align(self, target_width, align):
+        if self.width < target_width:
+            if align == 'left':
+                return self.pad(0, target_width - self.width)
+            elif align == 'center':
+                left = (target_width - self.width) // 2
+                return self.pad(left, target_width - self.width - left)
+            elif align == 'right':
+                return self.pad(target_width - self.width, 0)
+        elif self.width > target_width:
+            if align == 'left':
+                return self.crop(0, target_width)
+            elif align == 'center':
+                return self.crop((self.width - target_width) // 2, target_width)
+            elif align == 'right':
+                return self.crop(self.width - target_width, target_width)
+        return self
+    
+    def blend(self, other):
+        # OR both bitmaps together, the result has the size of the wider one
+        if self.width >= other.width:
+            base, top = self, other
+        else:
+            base, top = other, self
+        
+        overlap = top.width
+        merged = int.from_bytes(base.columns[:overlap], 'big') | int.from_bytes(top.columns, 'big')
+        columns = merged.to_bytes(overlap, 'big') + base.columns[overlap:]
+        return MatrixBitmap(base.width, max(base.height, top.height), columns)
+
+class MatrixAnimation(object):
+    """
+    The precomputed frames of an animation, shown at a fixed frame rate.
+    Consecutive identical frames are merged, so only frames that actually differ have to be sent.
+    """
+    
+    def __init__(self, frames, fps = 10, loop = False):
+        if not frames:
+            raise ValueError("An animation needs at least one frame")
+        
+        self.fps = fps
+        self.loop = loop
+        self.num_ticks = len(frames)
+        # Each distinct frame and the tick it starts at
+        self.frames = []
+        self.starts = []
+        for tick, frame in enumerate(frames):
+            if self.frames and self.frames[-1] == frame:
+                continue
+            # Pack in advance so sending the frame costs nothing
+            frame.blocks()
+            self.frames.append(frame)
+            self.starts.append(tick)
+    
+    @classmethod
+    def build(cls, bitmap, effect, width, fps = 10, loop = None, step = 1):
+        """
+        Build the frames of an effect for a display that is width pixels wide.
+        slide-up and slide-down move the bitmap in from the bottom or the top, wipe-left and wipe-right reveal it
+        from the right or the left, blink alternates between the bitmap and a blank display, and ticker
+        scrolls it through the display from right to left, step pixels at a time.
+        Only blink and ticker loop by default, the others stop at the last frame.
+        """
+        
+        if effect not in ANIMATION_EFFECTS:
+            raise ValueError("Invalid animation effect: %s" % effect)
+        if loop is None:
+            loop = effect in ('blink', 'ticker')
+        step = max(1, step)
+        
+        if effect == 'ticker':
+            padded = bitmap.pad(width, width)
+            frames = [padded.crop(offset, width) for offset in range(0, bitmap.width + width + 1, step)]
+            return cls(frames, fps, loop)
+        
+        bitmap = bitmap.align(width, 'left')
+        if effect == 'slide-up':
+            frames = [bitmap.shift(rows) for rows in range(bitmap.height, -1, -step)]
+        elif effect == 'slide-down':
+            frames = [bitmap.shift(-rows) for rows in range(bitmap.height, -1, -step)]
+        elif effect == 'wipe-right':
+            frames = [bitmap.crop(0, shown).pad(0, width - shown) for shown in range(0, width + 1, step)]
+        elif effect == 'wipe-left':
+            frames = [bitmap.crop(width - shown, shown).pad(width - shown, 0) for shown in range(0, width + 1, step)]
+        elif effect == 'blink':
+            frames = [bitmap, MatrixBitmap(width, bitmap.height)]
+        
+        # Make sure the animation ends with the complete bitmap
+        if effect != 'blink' and frames[-1] != bitmap:
+            frames.append(bitmap)
+        return cls(frames, fps, loop)
+    
+    def frame_at(self, elapsed):
+        """
+        Return the frame to show after the given number of seconds as (position, frame, next change).
+        position counts the frames shown since the start (across loops), so skipped frames can be detected.
+        next change is the time in seconds since the start when the next frame is due, or None if the animation is over.
+        """
+        
+        tick = int(elapsed * self.fps)
+        cycle = 0
+        if tick >= self.num_ticks:
+            if not self.loop:
+                return len(self.frames) - 1, self.frames[-1], None
+            cycle, tick = divmod(tick, self.num_ticks)
+        
+        index = bisect.bisect_right(self.starts, tick) - 1
+        if index + 1 < len(self.frames):
+            next_tick = cycle * self.num_ticks + self.starts[index + 1]
+        elif self.loop and len(self.frames) > 1:
+            next_tick = (cycle + 1) * self.num_ticks
+        else:
+            next_tick = None
+        
+        position = cycle * len(self.frames) + index
+        return position, self.frames[index], next_tick / self.fps if next_tick is not None else None
+
+class TextLayout(object):
+    """
+    The segments of the last time string built by MatrixGraphics.build_time_text, so the next one
+    only needs to redraw the columns of the segments that changed.
+    """
+    
+    def __init__(self, font_path, size):
+        self.font_path = font_path
+        self.size = size
+        # (segment, x position, glyph run) for each segment
+        self.placements = []
+        # Full-height columns with the top row in the least significant bit, before cropping
+        self.columns = []
+
+class GlyphAtlas(object):
+    """
+    The glyphs of one font and size, rendered once and packed for every vertical position they're used at.
+    Text is put together by copying the columns of each glyph, so building it takes time linear in its length.
+    Glyphs are rendered when they are first used, all on the same baseline (see MatrixGraphics._render_glyph_run),
+    so the result only differs from PIL's by kerning.
+    """
+    
+    def __init__(self, render_glyph, top_offset, cell_width):
+        # render_glyph works like MatrixGraphics._render_glyph_run for a single character
+        self.render_glyph = render_glyph
+        self.top_offset = top_offset
+        self.cell_width = cell_width
+        # (advance in columns, columns before the pen, columns, top row, first and last column with ink,
+        # top and bottom of the box) by character
+        self.glyphs = {}
+        # (columns within the advance, (column, value) for ink outside of it) by (character, shift, visible rows)
+        self.packed = {}
+    
+    def get_glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            advance, columns, origin, box_top, box_bottom = self.render_glyph(char)
+            used = [x - origin for x, column in enumerate(columns) if column]
+            top = min((column & -column).bit_length() - 1 for column in columns if column) if used else None
+            glyph = self.glyphs[char] = (int(round(advance)), origin, columns, top, used[0] if used else None, used[-1] + 1 if used else None,
+                                         box_top, box_bottom)
+        return glyph
+    
+    def get_packed(self, char, glyph, shift, rows):
+        key = (char, shift, rows)
+        packed = self.packed.get(key)
+        if packed is None:
+            advance, origin, columns = glyph[:3]
+            if shift >= 0:
+                values = [REVERSED_BITS[((column & rows) >> shift) & 0xFF] for column in columns]
+            else:
+                values = [REVERSED_BITS[((column & rows) << -shift) & 0xFF] for column in columns]
+            body = bytes(values[origin:origin + advance]).ljust(advance, b"\x00")
+            outside = [(x - origin, value) for x, value in enumerate(values) if value and not origin <= x < origin + advance]
+            packed = self.packed[key] = (body, outside)
+        return packed
+    
+    def build(self, text, fixed = False):
+        # Lay out the glyphs and find the extent of the ink, which decides how the result is cropped
+        placements = []
+        left = right = top = box_top = box_bottom = None
+        pen = 0
+        for char in text:
+            glyph = self.get_glyph(char)
+            if fixed:
+                # Center each glyph in its cell
+                x = pen + max(0, (self.cell_width - glyph[0]) // 2)
+                pen += self.cell_width
+            else:
+                x = pen
+                pen += glyph[0]
+            placements.append((char, x, glyph))
+            if glyph[3] is not None:
+                # Like with PIL, ink left of the start of the text is cut off
+                left = max(0, x + glyph[4]) if left is None else min(left, max(0, x + glyph[4]))
+                right = x + glyph[5] if right is None else max(right, x + glyph[5])
+                top = glyph[3] if top is None else min(top, glyph[3])
+            box_top = glyph[6] if box_top is None else min(box_top, glyph[6])
+            box_bottom = glyph[7] if box_bottom is None else max(box_bottom, glyph[7])
+        
+        if top is None:
+            return MatrixBitmap(0)
+        
+        # The top of the text ends up at top_offset, like with _prepare_text
+        rows = crop_rows(top, box_top, box_bottom, self.top_offset)
+        if not (rows >> top) & 1:
+            # The top of the text is cut off
+            top = min([(column & rows & -(column & rows)).bit_length() - 1 for char, x, glyph in placements for column in glyph[2] if column & rows] or [top])
+        shift = top - self.top_offset
+        canvas = bytearray(max(pen, right))
+        outside = []
+        for char, x, glyph in placements:
+            body, glyph_outside = self.get_packed(char, glyph, shift, rows)
+            canvas[x:x + len(body)] = body
+            if glyph_outside:
+                outside.append((x, glyph_outside))
+        # Ink outside of a glyph's advance is added last so neighbouring glyphs don't overwrite it
+        for x, glyph_outside in outside:
+            for offset, value in glyph_outside:
+                if 0 <= x + offset < len(canvas):
+                    canvas[x + offset] |= value
+        return MatrixBitmap(right - left, 8, canvas[left:right])
+
 class MatrixGraphics(object):
-    def __init__(self, controller, debug = False):
+    def __init__(self, controller, text_cache_size = 64, font_index_file = FONT_INDEX_FILE, debug = False):
         self.debug = debug
         self.controller = controller
-        self.font_list = {}
-        self.load_fonts()
+        # The font list is loaded on first use, see the font_list property
+        self._font_list = None
+        self.font_index_file = font_index_file
+        # Resolved font queries and loaded fonts, see get_font and load_font
+        self.font_query_cache = {}
+        self.font_cache = {}
+        # LRU cache of rendered texts, see build_text
+        self.text_cache = OrderedDict()
+        # build_text may be called from several threads at once
+        self.text_cache_lock = threading.Lock()
+        self.text_cache_size = text_cache_size
+        self.text_cache_hits = 0
+        self.text_cache_misses = 0
+        # LRU cache of rendered time string segments, see build_time_text
+        self.glyph_cache = OrderedDict()
+        self.glyph_cache_lock = threading.Lock()
+        # Glyph atlases by (font_path, size), see get_atlas
+        self.atlases = {}
+        self.atlas_lock = threading.Lock()
     
-    def load_fonts(self):
+    @property
+    def font_list(self):
+        if self._font_list is None:
+            self.load_fonts()
+        return self._font_list
+    
+    def load_fonts(self, use_index = True):
+        # Reuse the font index from a previous run if no font directory has changed since
+        if use_index and self._load_font_index():
+            self.font_query_cache.clear()
+            return
+        
         def _parse_line(line):
             try:
                 path, name, style = [part.strip() for part in line.split(":")]
@@ -107,17 +564,82 @@ class MatrixGraphics(object):
         
         if self.debug:
             print("Loading available fonts...")
-
+        
         raw_list = subprocess.check_output(("fc-list", "-f", "%{file}:%{family}:%{style}\n", ":fontformat=TrueType")).decode('utf-8')
         font_list = dict([_parse_line(line) for line in raw_list.splitlines()])
+        self._font_list = {}
         for path, name in font_list.items():
             if path and name:
-                self.font_list[name.lower()] = path
-
+                self._font_list[name.lower()] = path
+        self.font_query_cache.clear()
+        
+        if self.debug:
+            print("Found %i fonts:\n%s" % (len(self._font_list), "\n".join(["- " + name.title() for name in sorted(self._font_list.keys())])))
+        
+        self._save_font_index()
+    
+    def _load_font_index(self):
+        if not self.font_index_file:
+            return False
+        
+        try:
+            with open(self.font_index_file, 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        
+        if not isinstance(index, dict) or index.get('version') != FONT_INDEX_VERSION:
+            return False
+        
+        # The file may have been damaged or written by something else, in which case it's rebuilt like an outdated one
+        fonts = index.get('fonts')
+        if not isinstance(fonts, dict) or not all(isinstance(name, str) and isinstance(path, str) for name, path in fonts.items()):
+            if self.debug:
+                print("Invalid font index, rebuilding...")
+            return False
+        
+        if get_font_dir_mtimes(fonts.values()) != index.get('mtimes'):
+            if self.debug:
+                print("Font directories have changed, rebuilding font index...")
+            return False
+        
+        self._font_list = fonts
         if self.debug:
-            print("Found %i fonts:\n%s" % (len(self.font_list), "\n".join(["- " + name.title() for name in sorted(self.font_list.keys())])))
+            print("Loaded %i fonts from %s" % (len(self._font_list), self.font_index_file))
+        return True
+    
+    def _save_font_index(self):
+        if not self.font_index_file:
+            return
+        
+        index = {
+            'version': FONT_INDEX_VERSION,
+            'mtimes': get_font_dir_mtimes(self._font_list.values()),
+            'fonts': self._font_list
+        }
+        
+        try:
+            directory = os.path.dirname(self.font_index_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first so concurrent readers never see a partial index
+            temp_file = "%s.%i.tmp" % (self.font_index_file, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_file, self.font_index_file)
+        except (IOError, OSError):
+            if self.debug:
+                print("Could not write font index to %s" % self.font_index_file)
     
     def get_font(self, query):
+        # Resolving a partial name means scanning every installed font, so remember the result
+        path = self.font_query_cache.get(query)
+        if path is None:
+            path = self._find_font(query)
+            self.font_query_cache[query] = path
+        return path
+    
+    def _find_font(self, query):
         query = query.lower()
         # Perform a direct lookup first
         path = self.font_list.get(query)
@@ -139,134 +661,93 @@ class MatrixGraphics(object):
         else:
             return self.get_font(DEFAULT_FONT)
     
-    def image_to_long_bitmap(self, image):
-        # Convert an image to a bitmap where pixels are represented as an array of 1 and 0
-        if not isinstance(image, Image.Image):
-            image = Image.open(image)
+    def load_font(self, font_path, size):
+        """
+        Return the font at the given path along with the top offset needed to align it to the baseline.
+        Both are memoized per (font_path, size).
+        """
+        
+        key = (font_path, size)
+        cached = self.font_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        font = ImageFont.truetype(font_path, size)
         
-        long_bitmap = []
-        pixels = image.load()
-        width, height = image.size
-        for y in range(height):
-            row = []
-            for x in range(width):
-                pixel = pixels[x, y]
-                row.append(int(pixel[:3] != (0, 0, 0))) # 0 (black) or 1 (any other color)
-            long_bitmap.append(row)
+        # Calculate the base height of the font in order to get the alignment right
+        # Also, the size the font reports seems to be unreliable so we have to go a bit further.
+        # The right and bottom edge of getbbox are what the deprecated getsize used to return.
+        TEST_TEXT = "GgFf"
+        approx_base_size = font.getbbox(TEST_TEXT)[2:]
+        test_image = Image.new("RGB", approx_base_size, (0, 0, 0))
+        test_draw = ImageDraw.Draw(test_image)
+        test_draw.fontmode = "1"
+        test_draw.text((0, 0), TEST_TEXT, (255, 255, 255), font = font)
+        base_left, base_top, base_right, base_bottom = test_image.getbbox()
+        base_height = base_bottom - base_top
+        top_offset = 8 - base_height
         
-        return long_bitmap
+        self.font_cache[key] = (font, top_offset)
+        return font, top_offset
+    
+    def image_to_long_bitmap(self, image):
+        # Convert an image to a bitmap where pixels are represented as an array of 1 and 0
+        binary = threshold_image(image, 'L')
+        width, height = binary.size
+        data = binary.tobytes()
+        return [list(data[y * width:(y + 1) * width]) for y in range(height)]
     
     def image_to_short_bitmap(self, image):
         # Convert an image to a bitmap where pixels are represented as 8-bit integers in groups of 8
-        if not isinstance(image, Image.Image):
-            image = Image.open(image)
-        
-        short_bitmap = []
-        temp_bitmap = []
-        data = "".join(map(str, [int(pixel[:3] != (0, 0, 0)) for pixel in image.getdata()]))
-        width, height = image.size
-        rows = [data[i:i + width] for i in range(0, len(data), width)]
-        for row in rows:
-            short_row = []
-            # Iterate over the string in chunks of 8
-            cur_x_pos = 0
-            while cur_x_pos < len(row):
-                # Convert the current chunk into an 8-bit value
-                chunk = row[cur_x_pos:cur_x_pos + 8].ljust(8, "0")
-                short_row.append(int(chunk, 2))
-                cur_x_pos += 8
-            temp_bitmap.append(short_row)
-        
-        for x in range(len(temp_bitmap[0])):
-            new_block = []
-            for y in range(height):
-                new_block.append(temp_bitmap[y][x])
-            short_bitmap.append(new_block)
-        return short_bitmap
+        bilevel = threshold_image(image)
+        width, height = bilevel.size
+        # Mode "1" packs each row into bytes with the leftmost pixel in the MSB, exactly the block format
+        rows = bilevel.tobytes()
+        stride = (width + 7) // 8
+        return [list(rows[block::stride]) for block in range(stride)]
     
     def long_bitmap_to_short_bitmap(self, long_bitmap):
         # Convert a "long-form" bitmap to a "short-form" bitmap
-        short_bitmap = []
-        temp_bitmap = []
-        for row in long_bitmap:
-            short_row = []
-            # Turn the row into a string of 1 and 0
-            row_str = "".join(map(str, row))
-            # Iterate over the string in chunks of 8
-            cur_x_pos = 0
-            while cur_x_pos < len(row_str):
-                # Convert the current chunk into an 8-bit value
-                chunk = row_str[cur_x_pos:cur_x_pos + 8].ljust(8, "0")
-                short_row.append(int(chunk, 2))
-                cur_x_pos += 8
-            temp_bitmap.append(short_row)
-        
-        for x in range(len(temp_bitmap[0])):
-            new_block = []
-            for y in range(len(long_bitmap)):
-                new_block.append(temp_bitmap[y][x])
-            short_bitmap.append(new_block)
-        return short_bitmap
-    
-    def align_image(self, image, align):
+        return MatrixBitmap.coerce(long_bitmap).to_short_bitmap()
+    
+    def get_width(self, width = None):
+        # The width to align to: the given one, or that of the displays on our controller
+        return width if width is not None else self.controller.num_blocks * 8
+    
+    def align_image(self, image, align, width = None):
         if not isinstance(image, Image.Image):
             image = Image.open(image)
         
         if align == 'left':
-            aligned_image = Image.new('RGB', (self.controller.num_blocks * 8, 8), (0, 0, 0))
+            aligned_image = Image.new('RGB', (self.get_width(width), 8), (0, 0, 0))
             aligned_image.paste(image, (0, 0))
         elif align == 'center':
-            aligned_image = Image.new('RGB', (self.controller.num_blocks * 8, 8), (0, 0, 0))
+            aligned_image = Image.new('RGB', (self.get_width(width), 8), (0, 0, 0))
             aligned_image.paste(image, (int((aligned_image.size[0] - image.size[0]) / 2), 0))
         elif align == 'right':
-            aligned_image = Image.new('RGB', (self.controller.num_blocks * 8, 8), (0, 0, 0))
+            aligned_image = Image.new('RGB', (self.get_width(width), 8), (0, 0, 0))
             aligned_image.paste(image, (aligned_image.size[0] - image.size[0], 0))
         else:
             aligned_image = image
         
         return aligned_image
     
+    def align_bitmap(self, bitmap, align, width = None):
+        return MatrixBitmap.coerce(bitmap).align(self.get_width(width), align)
+    
     def align_long_bitmap(self, long_bitmap, align):
-        bitmap_width = len(long_bitmap[0])
-        target_width = self.controller.num_blocks * 8
-        
-        if bitmap_width == target_width:
-            pass
-        elif bitmap_width < target_width:
-            if align == 'left':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] += [0] * (target_width - bitmap_width)
-            elif align == 'center':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] = [0] * int((target_width - bitmap_width) / 2) + long_bitmap[i]
-                    long_bitmap[i] += [0] * (int((target_width - bitmap_width) / 2) + bitmap_width % 2)
-            elif align == 'right':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] = [0] * (target_width - bitmap_width) + long_bitmap[i]
-            else:
-                pass
-        elif bitmap_width > target_width:
-            if align == 'left':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] = long_bitmap[i][:target_width]
-            elif align == 'center':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] = long_bitmap[i][int(target_width / 2):][:-(int(target_width / 2) - bitmap_width % 2)]
-            elif align == 'right':
-                for i in range(len(long_bitmap)):
-                    long_bitmap[i] = long_bitmap[i][-target_width:]
-            else:
-                pass
-        
-        return long_bitmap
+        return self.align_bitmap(long_bitmap, align).to_long_bitmap()
+    
+    def build_image_bitmap(self, image, align = None, width = None):
+        aligned_image = self.align_image(image, align, width)
+        return MatrixBitmap.from_image(aligned_image)
     
     def build_image(self, image, align = None):
-        aligned_image = self.align_image(image, align)
-        return self.image_to_long_bitmap(aligned_image)
+        return self.build_image_bitmap(image, align).to_long_bitmap()
     
     def send_image(self, image, align = None):
         aligned_image = self.align_image(image, align)
-        return self.controller.send_bitmap(self.image_to_short_bitmap(aligned_image))
+        return self.controller.send_bitmap(MatrixBitmap.from_image(aligned_image).blocks())
     
     def _prepare_text(self, text, font = "sans", size = 11):
         """
@@ -279,28 +760,15 @@ class MatrixGraphics(object):
         data = [('text', part) for part in modified_text.split("\x00")]
         data = [x for t in zip(data, [('image', path) for path in paths]) for x in t]
         
-        font_path = self.get_font(font)
-        font = ImageFont.truetype(font_path, size)
-
-        # Calculate the base height of the font in order to get the alignment right
-        # Also, font.getsize() seems to be unreliable so we have to go a bit further
-        TEST_TEXT = "GgFf"
-        approx_base_size = font.getsize(TEST_TEXT)
-        test_image = Image.new("RGB", approx_base_size, (0, 0, 0))
-        test_draw = ImageDraw.Draw(test_image)
-        test_draw.fontmode = "1"
-        test_draw.text((0, 0), TEST_TEXT, (255, 255, 255), font = font)
-        base_left, base_top, base_right, base_bottom = test_image.getbbox()
-        base_height = base_bottom - base_top
-        top_offset = 8 - base_height
-
+        font, top_offset = self.load_font(self.get_font(font), size)
+        
         images = []
         for what, value in data:
             if not value:
                 continue
             
             if what == 'text':
-                width, height = font.getsize(value)
+                left, top, width, height = font.getbbox(value)
                 image = Image.new('RGB', (width, height + top_offset), (0, 0, 0))
                 draw = ImageDraw.Draw(image)
                 draw.fontmode = "1" # Turn off antialiasing by setting the color mode to bilevel
@@ -324,33 +792,232 @@ class MatrixGraphics(object):
         
         return complete_image
     
-    def build_text(self, text, font = "sans", size = 11, align = None):
-        image = self._prepare_text(text, font, size)
-        return self.image_to_long_bitmap(self.align_image(image, align))
+    def get_atlas(self, font_path, size):
+        key = (font_path, size)
+        with self.atlas_lock:
+            atlas = self.atlases.get(key)
+            if atlas is None:
+                font, top_offset = self.load_font(font_path, size)
+                cell_width = max(int(round(font.getlength(char))) for char in ATLAS_CELL_CHARACTERS)
+                atlas = self.atlases[key] = GlyphAtlas(lambda char: self._render_glyph_run(char, font_path, size), top_offset, cell_width)
+        return atlas
+    
+    def build_text_bitmap(self, text, font = "sans", size = 11, align = None, renderer = 'pil', width = None):
+        """
+        Render text to a MatrixBitmap. The text is aligned to width, by default the width of the displays on our controller.
+        renderer is one of RENDERERS. The atlas renderers compose the text from pre-rendered glyphs, which is a lot faster.
+        With proportional advance (atlas), the result is the same as with PIL for pixel fonts, while with other fonts
+        glyphs may be a pixel to the left or right of where PIL would put them because kerning is left out;
+        fixed advance (atlas-fixed) puts every character in a cell as wide as the widest ASCII character.
+        Texts with embedded images are always rendered with PIL.
+        """
+        
+        if renderer not in RENDERERS:
+            raise ValueError("Unknown renderer: %s" % renderer)
+        
+        # Rendered bitmaps are immutable, so they can be handed out straight from the cache.
+        # Texts with embedded images aren't cached, since the image files may change.
+        width = self.get_width(width)
+        key = (text, font, size, align, renderer, width)
+        use_cache = self.text_cache_size > 0 and "@img:" not in text
+        if use_cache:
+            with self.text_cache_lock:
+                bitmap = self.text_cache.get(key)
+                if bitmap is not None:
+                    self.text_cache.move_to_end(key)
+                    self.text_cache_hits += 1
+                    return bitmap
+                self.text_cache_misses += 1
+        
+        # Rendering happens outside of the lock so other threads aren't held up by it
+        if renderer == 'pil' or "@img:" in text:
+            image = self._prepare_text(text, font, size)
+            bitmap = MatrixBitmap.from_image(self.align_image(image, align, width))
+        else:
+            bitmap = self.get_atlas(self.get_font(font), size).build(text, renderer == 'atlas-fixed')
+            if align is not None:
+                bitmap = bitmap.align(width, align)
+        if use_cache:
+            with self.text_cache_lock:
+                self.text_cache[key] = bitmap
+                while len(self.text_cache) > self.text_cache_size:
+                    self.text_cache.popitem(last = False)
+        return bitmap
+    
+    def build_text(self, text, font = "sans", size = 11, align = None, renderer = 'pil', width = None):
+        return self.build_text_bitmap(text, font, size, align, renderer, width).to_long_bitmap()
+    
+    def clear_text_cache(self):
+        with self.text_cache_lock:
+            self.text_cache.clear()
+            self.text_cache_hits = 0
+            self.text_cache_misses = 0
+        with self.glyph_cache_lock:
+            self.glyph_cache.clear()
+        with self.atlas_lock:
+            self.atlases.clear()
     
-    def send_text(self, text, font = "sans", size = 11, align = None):
-        image = self._prepare_text(text, font, size)
-        return self.controller.send_bitmap(self.image_to_short_bitmap(self.align_image(image, align)))
+    def _render_glyph_run(self, text, font_path, size):
+        """
+        Render a piece of text on its own, without cropping it.
+        Returns how far it advances the pen, its columns with the top row in the least significant bit,
+        how many of the columns are left of the pen, and the top and bottom of its box as _prepare_text would draw it
+        (see crop_rows). Every run of the same font and size is drawn on the same baseline, so runs can be put side by side
+        and only differ from text drawn at once by kerning.
+        """
+        
+        key = (text, font_path, size)
+        with self.glyph_cache_lock:
+            run = self.glyph_cache.get(key)
+            if run is not None:
+                self.glyph_cache.move_to_end(key)
+                return run
+        
+        font, top_offset = self.load_font(font_path, size)
+        ascent, descent = font.getmetrics()
+        # Leave room for glyphs that reach to the left of the pen or beyond the ascent or descent
+        margin = size
+        height = ascent + descent + 2 * margin
+        columns = self._render_columns(text, font, margin, height)
+        
+        # PIL puts the tallest glyph of a text at the top of the image it draws into and everything else relative to it,
+        # by the size of the bitmaps. The image itself is placed by the outlines, which can be a pixel taller,
+        # so the whole text moves by a pixel depending on which glyphs it contains. That doesn't matter for a text
+        # drawn at once, which is cropped anyway, but runs drawn on their own wouldn't line up. So the run is also drawn
+        # after the same reference glyphs every time, which decide the position instead, and moved to where it ends up there.
+        space_width = font.getlength(" ")
+        prefix = GLYPH_REFERENCE + " " * int(math.ceil(3 * margin / space_width) if space_width > 0 else 3 * margin)
+        reference = self._render_columns(prefix + text, font, margin, height)
+        # Only look at the columns of the run, which start at most margin columns left of its pen.
+        # The gap keeps them apart from the reference glyphs.
+        start = int(font.getlength(prefix + text) - font.getlength(text))
+        top = self._columns_top(columns)
+        reference_top = self._columns_top(reference[start:])
+        if top is not None and reference_top is not None:
+            shift = reference_top - top
+            columns = [column << shift if shift >= 0 else column >> -shift for column in columns]
+        
+        lead = next((x for x in range(margin) if columns[x]), margin)
+        run = (font.getlength(text), tuple(columns[lead:]), margin - lead, font.getbbox(text, mode = '1')[1], font.getbbox(text)[3])
+        with self.glyph_cache_lock:
+            self.glyph_cache[key] = run
+            while len(self.glyph_cache) > GLYPH_CACHE_SIZE:
+                self.glyph_cache.popitem(last = False)
+        return run
+    
+    @staticmethod
+    def _render_columns(text, font, margin, height):
+        # Draw text in a bilevel image with its top at margin and return its columns, with the top row in the least significant bit
+        width = int(math.ceil(font.getlength(text))) + 2 * margin
+        image = Image.new('L', (width, height), 0)
+        draw = ImageDraw.Draw(image)
+        draw.fontmode = "1"
+        draw.text((margin, margin - font.getbbox(text, mode = '1', anchor = 'ls')[1]), text, 255, font = font, anchor = 'ls')
+        data = image.tobytes()
+        columns = []
+        for x in range(width):
+            column = 0
+            for y in range(height):
+                if data[y * width + x]:
+                    column |= 1 << y
+            columns.append(column)
+        return columns
+    
+    @staticmethod
+    def _columns_top(columns):
+        # The topmost row with ink in any of the columns
+        used = [column for column in columns if column]
+        if not used:
+            return None
+        return min((column & -column).bit_length() - 1 for column in used)
+    
+    def build_time_text(self, text, font = "sans", size = 11, align = None, layout = None, width = None):
+        """
+        Build a bitmap like build_text_bitmap for text that changes in small steps, like a clock.
+        The text is put together from separately rendered segments (single digits and the runs of text between them)
+        which are cached, and only the columns of segments that differ from the given layout are redrawn.
+        Returns the bitmap and the layout to pass in next time.
+        Unlike build_text_bitmap, there is no kerning between segments, so segments can be a pixel to the left or right
+        of where PIL would put them with some fonts, and embedded images aren't supported.
+        """
+        
+        font_path = self.get_font(font)
+        _, top_offset = self.load_font(font_path, size)
+        if layout is None or layout.font_path != font_path or layout.size != size:
+            layout = TextLayout(font_path, size)
+        
+        placements = []
+        pen = 0.0
+        for segment in TIME_STRING_SEGMENTS.findall(text):
+            run = self._render_glyph_run(segment, font_path, size)
+            # Placed by their first column, ink left of the start of the text is cut off like with PIL
+            placements.append((segment, int(round(pen)) - run[2], run))
+            pen += run[0]
+        
+        # Find the column ranges that have changed, both where old segments were and where new ones are
+        columns = layout.columns
+        dirty = []
+        for index in range(max(len(placements), len(layout.placements))):
+            new = placements[index] if index < len(placements) else None
+            old = layout.placements[index] if index < len(layout.placements) else None
+            if new is not None and old is not None and new[0] == old[0] and new[1] == old[1]:
+                continue
+            for placement in (new, old):
+                if placement is not None:
+                    dirty.append((max(0, placement[1]), placement[1] + len(placement[2][1])))
+        
+        total_width = max([x + len(run[1]) for segment, x, run in placements] or [0])
+        if len(columns) < total_width:
+            columns.extend([0] * (total_width - len(columns)))
+        else:
+            del columns[total_width:]
+        
+        for start, end in dirty:
+            end = min(end, total_width)
+            for x in range(start, end):
+                columns[x] = 0
+            # Segments may draw outside of their advance width, so combine all that overlap
+            for segment, x, run in placements:
+                for pos in range(max(start, x), min(end, x + len(run[1]))):
+                    columns[pos] |= run[1][pos - x]
+        
+        layout.placements = placements
+        
+        # Crop and position the result the same way _prepare_text does: the top of the text ends up at top_offset
+        used = [x for x, column in enumerate(columns) if column]
+        if used:
+            left, right = used[0], used[-1] + 1
+            top = min((columns[x] & -columns[x]).bit_length() - 1 for x in used)
+            rows = crop_rows(top, min(run[3] for segment, x, run in placements), max(run[4] for segment, x, run in placements), top_offset)
+            visible = [column & rows for column in columns[left:right]]
+            if not (rows >> top) & 1:
+                # The top of the text is cut off
+                top = min([(column & -column).bit_length() - 1 for column in visible if column] or [top])
+            shift = top - top_offset
+            if shift >= 0:
+                cropped = bytes(REVERSED_BITS[(column >> shift) & 0xFF] for column in visible)
+            else:
+                cropped = bytes(REVERSED_BITS[(column << -shift) & 0xFF] for column in visible)
+        else:
+            cropped = b""
+        
+        bitmap = MatrixBitmap(len(cropped), 8, cropped)
+        if align is not None:
+            bitmap = bitmap.align(self.get_width(width), align)
+        return bitmap, layout
+    
+    def send_text(self, text, font = "sans", size = 11, align = None, renderer = 'pil'):
+        return self.controller.send_bitmap(self.build_text_bitmap(text, font, size, align, renderer).blocks())
     
     def send_long_bitmap(self, bitmap, align = None):
-        new_bitmap = self.align_long_bitmap(bitmap, align)
-        return self.controller.send_bitmap(self.long_bitmap_to_short_bitmap(new_bitmap))
+        new_bitmap = self.align_bitmap(bitmap, align)
+        return self.controller.send_bitmap(new_bitmap.blocks())
+    
+    def build_animation(self, bitmap, effect, fps = 10, loop = None, step = 1):
+        return MatrixAnimation.build(MatrixBitmap.coerce(bitmap), effect, self.controller.num_blocks * 8, fps, loop, step)
+    
+    def blend_bitmaps(self, bitmap1, bitmap2):
+        return MatrixBitmap.coerce(bitmap1).blend(MatrixBitmap.coerce(bitmap2))
     
     def blend_long_bitmaps(self, bitmap1, bitmap2):
-        if len(bitmap1[0]) >= len(bitmap2[0]):
-            base = bitmap1
-            top = bitmap2
-        else:
-            base = bitmap2
-            top = bitmap1
-        
-        new_bitmap = []
-        for y in range(len(base)):
-            row = []
-            for x in range(len(base[0])):
-                if x < len(top[0]):
-                    row.append(base[y][x] or top[y][x])
-                else:
-                    row.append(base[y][x])
-            new_bitmap.append(row)
-        return new_bitmap
\ No newline at end of file
+        return self.blend_bitmaps(bitmap1, bitmap2).to_long_bitmap()
\ No newline at end of file
@@ -17,434 +17,994 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 """
-This file contains the classes needed to operate a server which controls four matrix displays.
+This file contains the classes needed to operate a server which controls any number of matrix displays
+on one or more serial buses (up to four displays per bus through the multiplexer).
 The server operates on a simple JSON-based protocol. The full protocol specification can be found
 in the SERVER_PROTOCOL.md file.
-The server runs as two threads; one to listen for messages and one to control the displays.
+The network thread runs an asyncio event loop, so any number of clients can be connected at the same time,
+and hands the messages to a single thread that processes them one after another.
+Every bus has its own control loop thread which sends frames to its displays, while a pool of render threads
+prepares the next frames. The configuration is saved to disk on another thread.
 """
 
+import asyncio
+import base64
+import concurrent.futures
 import datetime
 import json
+import math
 import os
+import queue
+import re
+import select
 import socket
+import struct
 import threading
 import time
 import traceback
 
-from .matrix_graphics import MatrixGraphics
-from .matrix_controller import MatrixError
+from .matrix_graphics import ANIMATION_EFFECTS, RENDERERS, MatrixAnimation, MatrixBitmap, MatrixGraphics
+from .matrix_controller import MatrixController, MatrixError
 
 CONFIG_FILE = ".current_config"
 
-def receive_message(sock):
+# The longest time the control loop sleeps without checking whether the server is still running
+MAX_IDLE_TIME = 5.0
+
+# How long to wait before retrying to update a display after an error
+RETRY_INTERVAL = 1.0
+
+# The number of connections that may be waiting to be accepted
+LISTEN_BACKLOG = 16
+
+# How often the network thread checks whether the server is still running
+NETWORK_POLL_INTERVAL = 1.0
+
+# How many displays are attached to a controller by default
+NUM_DISPLAYS = 4
+
+# The DTR and RTS levels that select each address of the display multiplexer
+MUX_ADDRESSES = {
+    0: (1, 0),
+    1: (0, 0),
+    2: (0, 1),
+    3: (1, 1)
+}
+
+# strftime directives whose result changes every second, time strings without them only change every minute
+TIME_STRING_SECOND_DIRECTIVES = "STXcrsf"
+TIME_STRING_DIRECTIVE = re.compile(r"%[-_0^#]*(.)")
+
+# Message framing. Legacy messages are prefixed with their length as five ASCII digits,
+# current ones with a version/flags byte and the length as a 32-bit big-endian integer.
+FRAME_VERSION_LEGACY = 1
+FRAME_VERSION = 2
+FRAME_VERSION_MASK = 0x0F
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_LEGACY_HEADER_SIZE = 5
+FRAME_LEGACY_MAX_SIZE = 99999
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Bitmaps are either sent as lists of rows of 0 and 1 or as base64 of the packed columns
+BITMAP_ENCODING_LIST = 'list'
+BITMAP_ENCODING_PACKED = 'packed'
+BITMAP_ENCODINGS = (BITMAP_ENCODING_LIST, BITMAP_ENCODING_PACKED)
+
+# Translation tables that clear the bits below the height of a packed column, by height
+PACKED_HEIGHT_MASKS = [bytes(value & (0xFF00 >> height) for value in range(256)) for height in range(9)]
+
+def receive_exactly(sock, length):
+    # Read exactly the given number of bytes into a preallocated buffer
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < length:
+        received = sock.recv_into(view[pos:], length - pos)
+        if not received:
+            raise ConnectionError("Connection closed while receiving message")
+        pos += received
+    return buffer
+
+def parse_frame_header(first_byte):
+    """
+    Look at the first byte of a message and return the framing version along with the number of header bytes still to be read.
+    Legacy messages start with an ASCII digit of their five-digit length, everything else starts with a version byte.
+    The reserved upper bits of the version byte can never be 3, since that would look like a digit.
+    """
+    
+    if 0x30 <= first_byte <= 0x39:
+        return FRAME_VERSION_LEGACY, FRAME_LEGACY_HEADER_SIZE - 1
+    if first_byte & ~FRAME_VERSION_MASK:
+        raise ValueError("Reserved framing bits set: 0x%02X" % first_byte)
+    if first_byte == FRAME_VERSION:
+        return FRAME_VERSION, FRAME_HEADER.size - 1
+    raise ValueError("Unknown message framing: 0x%02X" % first_byte)
+
+def parse_frame_length(version, header):
+    if version == FRAME_VERSION_LEGACY:
+        length = int(header)
+    else:
+        flags, length = FRAME_HEADER.unpack(header)
+    
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError("Message too large: %i bytes" % length)
+    return length
+
+def receive_message(sock, return_version = False):
     # Receive and parse an incoming message (prefixed with its length)
-    try:
-        length = int(sock.recv(5))
-        #print(length)
-        raw_data = bytearray()
-        l = 0
-        while l < length:
-            part_data = sock.recv(4096)
-            raw_data += part_data
-            l += len(part_data)
-        #raw_data = sock.recv(length)
-        #print(raw_data)
-        message = json.loads(raw_data.decode('utf-8'))
-    except:
-        raise
+    first_byte = receive_exactly(sock, 1)
+    version, remaining = parse_frame_header(first_byte[0])
+    length = parse_frame_length(version, first_byte + receive_exactly(sock, remaining))
+    message = json.loads(receive_exactly(sock, length).decode('utf-8'))
+    if return_version:
+        return message, version
     return message
 
-def send_message(sock, data):
-    # Build and send a message (prefixed with its length)
-    raw_data = json.dumps(data)
+async def receive_message_async(reader):
+    # Same as receive_message, for an asyncio stream. Returns the message and the framing version it was sent with.
+    first_byte = await reader.readexactly(1)
+    version, remaining = parse_frame_header(first_byte[0])
+    length = parse_frame_length(version, first_byte + await reader.readexactly(remaining))
+    raw_data = await reader.readexactly(length)
+    return json.loads(raw_data.decode('utf-8')), version
+
+def encode_message(data, version = None):
+    # Build a message (prefixed with its length)
+    if version is None:
+        version = FRAME_VERSION
+    
+    raw_data = json.dumps(data).encode('utf-8')
     length = len(raw_data)
-    message = "%05i%s" % (length, raw_data)
-    #print(message.encode('utf-8'))
-    sock.sendall(message.encode('utf-8'))
+    if version == FRAME_VERSION_LEGACY:
+        if length > FRAME_LEGACY_MAX_SIZE:
+            raise ValueError("Message too large for legacy framing: %i bytes" % length)
+        return ("%05i" % length).encode('ascii') + raw_data
+    return FRAME_HEADER.pack(FRAME_VERSION, length) + raw_data
 
-def discard_message(sock):
-    sock.setblocking(False)
-    try:
-        while True:
-            sock.recv(1024)
-    except socket.error:
-        pass
-    finally:
-        sock.setblocking(True)
+def send_message(sock, data, version = None):
+    sock.sendall(encode_message(data, version))
 
-class MatrixServer(object):
-    # This stores the actual bitmap that is displayed at the moment. Written exclusively by the display thread.
-    CURRENT_BITMAP = [
-        None,
-        None,
-        None,
-        None
-    ]
-    
-    # This stores the messages that should be displayed. Written exclusively by the message thread.
-    CURRENT_MESSAGE = [
-        None,
-        None,
-        None,
-        None
-    ]
-    
-    # This stores the current controller settings for each display.
-    CURRENT_CONFIG = [
-        {
-            'display_mode': 'auto',
-            'scroll_speed': 1,
-            'scroll_direction': 'left',
-            'scroll_mode': 'repeat-on-disappearance',
-            'scroll_gap': 5,
-            'power_state': False,
-            'blink_frequency': 0,
-            'stop_indicator': False,
-            'scroll_step': 1,
-            'stop_indicator_blink_frequency': 0
-        },
-        {
-            'display_mode': 'auto',
-            'scroll_speed': 1,
-            'scroll_direction': 'left',
-            'scroll_mode': 'repeat-on-disappearance',
-            'scroll_gap': 5,
-            'power_state': False,
-            'blink_frequency': 0,
-            'stop_indicator': False,
-            'scroll_step': 1,
-            'stop_indicator_blink_frequency': 0
-        },
-        {
-            'display_mode': 'auto',
-            'scroll_speed': 1,
-            'scroll_direction': 'left',
-            'scroll_mode': 'repeat-on-disappearance',
-            'scroll_gap': 5,
-            'power_state': False,
-            'blink_frequency': 0,
-            'stop_indicator': False,
-            'scroll_step': 1,
-            'stop_indicator_blink_frequency': 0
-        },
-        {
-            'display_mode': 'auto',
-            'scroll_speed': 1,
-            'scroll_direction': 'left',
-            'scroll_mode': 'repeat-on-disappearance',
-            'scroll_gap': 5,
-            'power_state': False,
-            'blink_frequency': 0,
-            'stop_indicator': False,
-            'scroll_step': 1,
-            'stop_indicator_blink_frequency': 0
+def encode_bitmap(bitmap, encoding = BITMAP_ENCODING_LIST):
+    # Prepare a bitmap (MatrixBitmap or long bitmap) for sending it over the network
+    if encoding == BITMAP_ENCODING_PACKED:
+        bitmap = MatrixBitmap.coerce(bitmap)
+        return {
+            'encoding': BITMAP_ENCODING_PACKED,
+            'width': bitmap.width,
+            'height': bitmap.height,
+            'data': base64.b64encode(bitmap.columns).decode('ascii')
         }
-    ]
-    
-    # This stores various things related to whether a display needs to be refreshed and whether the configuration has changed
-    UPDATE_DATA = [
-        {
-            'config_keys_changed': [],
-            'config_specific': {},
-            'message_changed': False,
-            'sequence_cur_pos': None,
-            'sequence_last_switched': None,
-            'time_string_last_result': None
-        },
-        {
-            'config_keys_changed': [],
-            'config_specific': {},
-            'message_changed': False,
-            'sequence_cur_pos': None,
-            'sequence_last_switched': None,
-            'time_string_last_result': None
-        },
-        {
-            'config_keys_changed': [],
-            'config_specific': {},
-            'message_changed': False,
-            'sequence_cur_pos': None,
-            'sequence_last_switched': None,
-            'time_string_last_result': None
-        },
-        {
-            'config_keys_changed': [],
-            'config_specific': {},
-            'message_changed': False,
-            'sequence_cur_pos': None,
-            'sequence_last_switched': None,
-            'time_string_last_result': None
+    elif encoding == BITMAP_ENCODING_LIST:
+        if isinstance(bitmap, MatrixBitmap):
+            return bitmap.to_long_bitmap()
+        return bitmap
+    raise ValueError("Unknown bitmap encoding: %s" % encoding)
+
+def data_message_bitmaps(message):
+    # The data of every item of a data message that carries a bitmap, also within sequences
+    items = message['data'] if message['type'] == 'sequence' else [message]
+    return [item['data'] for item in items if item['type'] == 'bitmap' or item['type'] == 'animation' and 'bitmap' in item['data']]
+
+def decode_bitmap(data):
+    # Turn a bitmap received over the network into a MatrixBitmap
+    if isinstance(data, dict):
+        if data.get('encoding') != BITMAP_ENCODING_PACKED:
+            raise ValueError("Unknown bitmap encoding: %s" % data.get('encoding'))
+        bitmap = MatrixBitmap(data['width'], data.get('height', 8), base64.b64decode(data['data'], validate = True))
+        if bitmap.height < 8:
+            # Rows below the height stay blank, whatever the client sent for them
+            bitmap = MatrixBitmap(bitmap.width, bitmap.height, bitmap.columns.translate(PACKED_HEIGHT_MASKS[bitmap.height]))
+        return bitmap
+    if not isinstance(data, list) or not all(isinstance(row, list) for row in data):
+        raise ValueError("A bitmap has to be a list of rows")
+    return MatrixBitmap.from_long_bitmap(data)
+
+def time_string_interval(text):
+    # How often the result of formatting a time string can change, in seconds
+    for directive in TIME_STRING_DIRECTIVE.findall(text):
+        if directive in TIME_STRING_SECOND_DIRECTIVES:
+            return 1
+    return 60
+
+# The controller settings a display starts out with
+DEFAULT_CONFIG = {
+    'display_mode': 'auto',
+    'scroll_speed': 1,
+    'scroll_direction': 'left',
+    'scroll_mode': 'repeat-on-disappearance',
+    'scroll_gap': 5,
+    'power_state': False,
+    'blink_frequency': 0,
+    'stop_indicator': False,
+    'scroll_step': 1,
+    'stop_indicator_blink_frequency': 0
+}
+
+class DisplayBus(object):
+    """
+    A matrix controller and the displays connected to it through the multiplexer.
+    Every bus is driven by its own thread, so displays on different buses are updated in parallel.
+    """
+    
+    def __init__(self, controller):
+        self.controller = controller
+        # The indices of the displays on this bus
+        self.displays = []
+        # Every change to a display is announced here so the bus thread can wake up immediately
+        self.update_queue = queue.Queue()
+        self.thread = None
+
+class DisplayState(object):
+    """
+    Everything the server knows about one display.
+    config, message and bitmap are never modified in place, only replaced, so readers can use them
+    as consistent snapshots without locking. Changes made by the network thread go through the lock.
+    """
+    
+    def __init__(self, bus, address = None):
+        self.lock = threading.Lock()
+        # Where to find the display: the bus it's on and its multiplexer address (None if there is no multiplexer)
+        self.bus = bus
+        self.address = address
+        
+        # The current controller settings
+        self.config = dict(DEFAULT_CONFIG)
+        # The message that should be displayed
+        self.message = None
+        # The actual bitmap (as a MatrixBitmap) that is displayed at the moment. Written exclusively by the display thread.
+        self.bitmap = None
+        # The message and the frames compiled for it in advance, see MatrixServer.compile_message
+        self.compiled = None
+        # The animation that is running (a MatrixAnimation), when it started and the position of the last frame shown
+        self.animation = None
+        self.animation_start = None
+        self.animation_position = None
+        
+        # Changes that haven't been picked up by the display thread yet
+        self.config_keys_changed = []
+        self.message_changed = False
+        
+        # While a client streams frames to the display (see MatrixServer.handle_stream), this is the stream that
+        # owns the display. Only the latest frame is kept, along with the number of frames it replaced.
+        self.stream = None
+        self.stream_frame = None
+        self.stream_frames_skipped = 0
+        
+        # Used exclusively by the display thread
+        self.config_specific = {}
+        self.sequence_cur_pos = None
+        self.sequence_last_switched = None
+        self.time_string_last_result = None
+        # Lets the next time string only redraw what has changed, see MatrixGraphics.build_time_text
+        self.time_string_layout = None
+        # What has last been sent to the display, so unchanged frames and parameters aren't sent again
+        self.sent_frame = None
+        self.sent_config = {}
+        # Controller calls prepared by the render stage, waiting to be sent by the bus thread
+        self.outbox = []
+        self.reset_stats()
+    
+    def reset_stats(self):
+        # How much serial I/O this display causes. Replaced as a whole so it can be read from other threads.
+        self.stats = {
+            'commits': 0,
+            'failed_commits': 0,
+            'io_time': 0.0,
+            'frames_shown': 0,
+            'frames_dropped': 0
         }
-    ]
     
-    def __init__(self, controller, port = 1810, allowed_ip_match = None, debug = False):
+    def has_changes(self):
+        return self.message_changed or bool(self.config_keys_changed) or self.stream_frame is not None
+    
+    def update_config(self, changes):
+        # Returns the keys that actually changed
+        with self.lock:
+            config = dict(self.config)
+            changed_keys = []
+            for key, value in changes.items():
+                if config[key] != value:
+                    config[key] = value
+                    changed_keys.append(key)
+            self.config = config
+            self.config_keys_changed.extend(changed_keys)
+        return changed_keys
+    
+    def set_message(self, message):
+        with self.lock:
+            self.message = message
+            self.message_changed = True
+    
+    def take_changes(self):
+        # Hand all pending changes to the display thread and reset them
+        with self.lock:
+            config_keys_changed = self.config_keys_changed
+            message_changed = self.message_changed
+            self.config_keys_changed = []
+            self.message_changed = False
+            return self.config, self.message, config_keys_changed, message_changed
+    
+    def restore_changes(self, config_keys_changed, message_changed):
+        # Give back changes taken by take_changes that couldn't be applied, so the next attempt picks them up again
+        with self.lock:
+            self.config_keys_changed = [key for key in config_keys_changed if key not in self.config_keys_changed] + self.config_keys_changed
+            self.message_changed = self.message_changed or message_changed
+    
+    def start_stream(self, stream):
+        # A new stream takes over from any previous one
+        with self.lock:
+            self.stream = stream
+            self.stream_frame = None
+            self.stream_frames_skipped = 0
+    
+    def push_stream_frame(self, stream, frame):
+        with self.lock:
+            if self.stream is not stream:
+                return False
+            if self.stream_frame is not None:
+                self.stream_frames_skipped += 1
+            self.stream_frame = frame
+            return True
+    
+    def end_stream(self, stream):
+        # Go back to showing the regular message
+        with self.lock:
+            if self.stream is stream:
+                self.stream = None
+                self.stream_frame = None
+                self.message_changed = True
+    
+    def take_stream_frame(self):
+        # Returns whether a stream is active, its latest frame (if it hasn't been taken yet) and how many frames were skipped
+        with self.lock:
+            frame, skipped = self.stream_frame, self.stream_frames_skipped
+            self.stream_frame = None
+            self.stream_frames_skipped = 0
+            return self.stream is not None, frame, skipped
+
+class MatrixServer(object):
+    def __init__(self, controller, port = 1810, allowed_ip_match = None, text_cache_size = 64, read_timeout = 5.0, keep_alive_timeout = 60.0, config_file = CONFIG_FILE, config_save_delay = 1.0, displays = None, render_threads = 2, debug = False):
+        """
+        displays is a list of (controller, multiplexer address) tuples, one for each display.
+        By default, NUM_DISPLAYS displays are attached to the given controller.
+        The configuration is saved to config_file, which every server in a process needs its own of.
+        """
+        
         self.debug = debug
         self.running = False
         self.controller = controller
         self.port = port
         self.allowed_ip_match = allowed_ip_match
+        self.read_timeout = read_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.config_file = config_file
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # prevent having to wait between reconnects
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.graphics = MatrixGraphics(controller, debug = self.debug)
+        
+        if displays is None:
+            displays = [(controller, address) for address in range(NUM_DISPLAYS)]
+        self.displays = []
+        self.buses = []
+        for display_controller, address in displays:
+            if address is not None and address not in MUX_ADDRESSES:
+                raise ValueError("Invalid multiplexer address: %s" % address)
+            for bus in self.buses:
+                if bus.controller is display_controller:
+                    break
+            else:
+                bus = DisplayBus(display_controller)
+                self.buses.append(bus)
+            bus.displays.append(len(self.displays))
+            self.displays.append(DisplayState(bus, address))
+        if not self.displays:
+            raise ValueError("At least one display has to be configured")
+        
+        if self.controller is None:
+            self.controller = self.buses[0].controller
+        # Texts are aligned to the width of the display they're for, not necessarily that of this controller
+        self.graphics = MatrixGraphics(self.controller, text_cache_size = text_cache_size, debug = self.debug)
+        # Frames are rendered here while the bus threads are busy transmitting
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(max_workers = render_threads)
+        # Sequences are compiled into ready-to-send frames here, see compile_message
+        self.compile_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
         self.message_thread = threading.Thread(target = self.network_listen)
-
+        # The configuration is saved on a separate thread, see save_config
+        self.config_save_delay = config_save_delay
+        self.config_save_due = None
+        self.config_save_condition = threading.Condition()
+        self.config_write_lock = threading.Lock()
+        self.config_thread = threading.Thread(target = self.config_writer, daemon = True)
+    
     def save_config(self):
-        if self.debug:
-            print("Saving configuration...")
-
-        config_save = {
-            'config': [],
-            'messages': []
-        }
-        
-        for display, config in enumerate(self.CURRENT_CONFIG):
-            config_save['config'].append({
-                'displays': [display],
-                'type': 'control',
-                'message': config
-            })
-
-        for display, message in enumerate(self.CURRENT_MESSAGE):
-            config_save['messages'].append({
-                'displays': [display],
-                'type': 'data',
-                'message': message
-            })
-
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config_save, f, indent = 4)
-
+        # Schedule the configuration to be saved. Bursts of changes are coalesced into a single write.
+        with self.config_save_condition:
+            if self.config_save_due is None:
+                self.config_save_due = time.time() + self.config_save_delay
+            self.config_save_condition.notify()
+    
+    def config_writer(self):
+        # Write the configuration in the background whenever a save is due
+        while True:
+            with self.config_save_condition:
+                while self.running and (self.config_save_due is None or self.config_save_due > time.time()):
+                    if self.config_save_due is None:
+                        self.config_save_condition.wait()
+                    else:
+                        self.config_save_condition.wait(self.config_save_due - time.time())
+                if not self.running:
+                    # stop() writes the final state itself
+                    break
+                self.config_save_due = None
+            
+            try:
+                self.write_config()
+            except:
+                traceback.print_exc()
+    
+    def write_config(self):
+        with self.config_write_lock:
+            if self.debug:
+                print("Saving configuration...")
+            
+            config_save = {
+                'config': [],
+                'messages': []
+            }
+            
+            for display, state in enumerate(self.displays):
+                config_save['config'].append({
+                    'displays': [display],
+                    'type': 'control',
+                    'message': state.config
+                })
+            
+            for display, state in enumerate(self.displays):
+                config_save['messages'].append({
+                    'displays': [display],
+                    'type': 'data',
+                    'message': state.message
+                })
+            
+            data = json.dumps(config_save, indent = 4)
+            
+            # Write to a temporary file and rename it, so a power cut can never leave a partially written file behind
+            temp_file = self.config_file + ".tmp"
+            with open(temp_file, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.config_file)
+            
+            # Make sure the rename itself has hit the disk
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.config_file)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+    
     def load_config(self):
         if self.debug:
             print("Loading configuration from file...")
-
+        
         try:
-            with open(CONFIG_FILE, 'r') as f:
+            with open(self.config_file, 'r') as f:
                 config_save = json.load(f)
-
+            
             for message in config_save['config'] + config_save['messages']:
                 self.process_message(message)
         except (IOError, OSError):
             if self.debug:
-                print("%s not found, using default configuration." % CONFIG_FILE)
+                print("%s not found, using default configuration." % self.config_file)
+        except ValueError:
+            print("%s is not valid, using default configuration." % self.config_file)
     
     def run(self):
         if self.debug:
             print("Starting server...")
-
+        
         self.load_config()
         self.running = True
+        self.config_thread.start()
         self.message_thread.start()
-        self.control_loop()
+        for bus in self.buses:
+            bus.thread = threading.Thread(target = self.control_loop, args = (bus,))
+            bus.thread.start()
+        
+        # The buses run on their own threads, this one only waits for them to finish (or for Ctrl+C)
+        try:
+            for bus in self.buses:
+                while bus.thread.is_alive():
+                    bus.thread.join(NETWORK_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.stop()
+        self.render_executor.shutdown()
+        self.compile_executor.shutdown()
     
     def stop(self):
-        self.save_config()
-
         if self.debug:
             print("Stopping server...")
         self.running = False
+        self.notify_update(None)
+        
+        with self.config_save_condition:
+            self.config_save_due = None
+            self.config_save_condition.notify()
+        self.write_config()
     
     def select_display(self, display):
         # Select a display using the multiplex chip
-        if display == 0:
-            self.controller.port.setDTR(1)
-            self.controller.port.setRTS(0)
-        elif display == 1:
-            self.controller.port.setDTR(0)
-            self.controller.port.setRTS(0)
-        elif display == 2:
-            self.controller.port.setDTR(0)
-            self.controller.port.setRTS(1)
-        elif display == 3:
-            self.controller.port.setDTR(1)
-            self.controller.port.setRTS(1)
+        state = self.displays[display]
+        state.bus.controller.select_address(state.address)
+        if state.address is None:
+            return
+        
+        dtr, rts = MUX_ADDRESSES[state.address]
+        state.bus.controller.port.setDTR(dtr)
+        state.bus.controller.port.setRTS(rts)
     
     def network_listen(self):
-        # Open the network socket and listen
+        # Open the network socket and serve clients until the server is stopped
         self.socket.bind(('', self.port))
-        self.socket.settimeout(5.0)
         if self.debug:
             print("Listening on port %i" % self.port)
-        self.socket.listen(1)
+        self.socket.listen(LISTEN_BACKLOG)
         
+        loop = asyncio.new_event_loop()
+        # Messages are processed one after another on a separate thread so slow work never blocks the event loop
+        self.message_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
         try:
-            while self.running:
-                try:
-                    # Wait for someone to connect
-                    conn, addr = self.socket.accept()
-                    ip, port = addr
-                    if self.allowed_ip_match is not None and not ip.startswith(self.allowed_ip_match):
-                        if self.debug:
-                            print("Discarding message from %s on port %i" % addr)
-                        discard_message(conn)
-                        continue
-                    
-                    if self.debug:
-                        print("Receiving message from %s on port %i" % addr)
-                    # Receive the message
-                    messages = receive_message(conn)
-                    if messages is None:
-                        # We received an invalid message, just discard it
-                        continue
-                    
-                    if type(messages) not in (list, tuple):
-                        messages = [messages]
-                    
-                    reply = {'success': True}
-                    for message in messages:
-                        reply = self.process_message(message)
-                        if not reply.get('success'):
-                            break
-                    
-                    if reply:
-                        send_message(conn, reply)
-                except socket.timeout: # Nothing special, just renew the socket every few seconds
-                    pass
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    traceback.print_exc()
+            loop.run_until_complete(self.serve())
         except KeyboardInterrupt:
             self.stop()
         finally:
+            self.message_executor.shutdown(wait = False)
+            loop.close()
             self.socket.close()
     
-    def control_loop(self):
+    async def serve(self):
+        self.connection_tasks = set()
+        server = await asyncio.start_server(self.handle_connection, sock = self.socket)
+        try:
+            while self.running:
+                await asyncio.sleep(NETWORK_POLL_INTERVAL)
+        finally:
+            server.close()
+            # Connections kept alive by clients have to be ended explicitly
+            for task in self.connection_tasks:
+                task.cancel()
+            await asyncio.gather(*self.connection_tasks, return_exceptions = True)
+            await server.wait_closed()
+    
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')[:2]
+        ip, port = addr
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        try:
+            if self.allowed_ip_match is not None and not ip.startswith(self.allowed_ip_match):
+                if self.debug:
+                    print("Discarding message from %s on port %i" % addr)
+                return
+            
+            # Don't let a stalled client hold the connection forever
+            timeout = self.read_timeout
+            while self.running:
+                try:
+                    request, version = await asyncio.wait_for(receive_message_async(reader), timeout)
+                except asyncio.IncompleteReadError as exc:
+                    if exc.partial:
+                        raise
+                    # The client closed the connection between two messages
+                    break
+                
+                if self.debug:
+                    print("Received message from %s on port %i" % addr)
+                if request is None:
+                    # We received an invalid message, just discard it
+                    break
+                
+                if isinstance(request, dict) and request.get('type') == 'stream':
+                    # The rest of the connection belongs to the stream
+                    await self.handle_stream(request, version, reader, writer)
+                    break
+                
+                loop = asyncio.get_running_loop()
+                reply = await loop.run_in_executor(self.message_executor, self.process_request, request)
+                if reply:
+                    # Reply with the same framing the client used
+                    writer.write(encode_message(reply, version))
+                    await writer.drain()
+                
+                if not self.keep_alive_timeout:
+                    break
+                # Keep the connection open for further messages
+                timeout = self.keep_alive_timeout
+        except asyncio.TimeoutError:
+            if self.debug:
+                print("Timeout while receiving message from %s on port %i" % addr)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.debug:
+                print("Connection to %s on port %i was lost" % addr)
+        except ValueError as exc:
+            if self.debug:
+                print("Invalid message from %s on port %i: %s" % (addr + (exc, )))
+        except asyncio.CancelledError:
+            # The server is shutting down
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            writer.close()
+            self.connection_tasks.discard(task)
+    
+    async def handle_stream(self, request, version, reader, writer):
+        """
+        After the stream request has been acknowledged, every message on the connection is a frame (a bitmap, preferably packed)
+        for the displays given in the request. Frames aren't answered, and a frame that arrives before the previous one
+        has been sent replaces it. The stream ends with a null message or when the connection is closed. It also ends when no frame
+        has arrived within the keep-alive timeout (or the read timeout if keep-alive is disabled), after an error reply has been sent.
+        """
+        
+        displays = request.get('displays') or []
+        error = None
+        if not isinstance(displays, list):
+            error = "Invalid displays: %s" % displays
+        else:
+            for display in displays:
+                if not isinstance(display, int) or not 0 <= display < len(self.displays):
+                    error = "Invalid display: %s" % display
+                    break
+        if error is not None:
+            writer.write(encode_message({'success': False, 'error': error}, version))
+            await writer.drain()
+            return
+        
+        stream = object()
+        for display in displays:
+            self.displays[display].start_stream(stream)
+        try:
+            writer.write(encode_message({'success': True}, version))
+            await writer.drain()
+            
+            timeout = self.keep_alive_timeout or self.read_timeout
+            while self.running:
+                frame, version = await asyncio.wait_for(receive_message_async(reader), timeout)
+                if frame is None:
+                    break
+                
+                bitmap = decode_bitmap(frame)
+                for display in displays:
+                    state = self.displays[display]
+                    if state.push_stream_frame(stream, bitmap.align(state.bus.controller.num_blocks * 8, request.get('align'))):
+                        self.notify_update(display)
+        except asyncio.IncompleteReadError as exc:
+            # The client may just close the connection to end the stream
+            if exc.partial:
+                raise
+        except asyncio.TimeoutError:
+            # Tell the client why the stream ended instead of just dropping the connection
+            if self.debug:
+                print("Stream from %s on port %i timed out" % writer.get_extra_info('peername')[:2])
+            writer.write(encode_message({'success': False, 'error': "No frame received for %g seconds" % timeout}, version))
+            await writer.drain()
+        finally:
+            for display in displays:
+                self.displays[display].end_stream(stream)
+                self.notify_update(display)
+    
+    def process_request(self, request):
+        # Requests wrapped in an envelope with a request ID get the ID back with the reply
+        if isinstance(request, dict) and 'request_id' in request:
+            return {'request_id': request['request_id'], 'reply': self.process_messages(request.get('messages', []))}
+        return self.process_messages(request)
+    
+    def process_messages(self, messages):
+        # Process a single message or a list of messages, stopping at the first one that fails
+        if type(messages) not in (list, tuple):
+            messages = [messages]
+        
+        reply = {'success': True}
+        for message in messages:
+            reply = self.process_message(message)
+            if not reply.get('success'):
+                break
+        return reply
+    
+    def control_loop(self, bus):
+        # Sleep until either a message changes the state of a display on the bus or a display is due for an update
+        deadlines = dict((display, None) for display in bus.displays)
         while self.running:
             try:
-                for display, message in enumerate(self.CURRENT_MESSAGE):
-                    now = time.time()
-                    update_data = self.UPDATE_DATA[display]
-                    
-                    # Process configuration changes
-                    for key in update_data['config_keys_changed']:
-                        self.set_config(display, key, self.CURRENT_CONFIG[display][key])
-                        if key == 'power_state' and self.CURRENT_CONFIG[display][key]:
-                            update_data['message_changed'] = True
-                    update_data['config_keys_changed'] = []
-                    
-                    if message is None or not self.CURRENT_CONFIG[display]['power_state']:
-                        self.select_display(display)
-                        try:
-                            self.controller.commit()
-                        except MatrixError:
-                            self.controller.clear_queue()
-                        time.sleep(0.25)
-                        continue
-                    
-                    if update_data['message_changed']:
-                        if message['type'] == 'sequence':
-                            update_data['sequence_cur_pos'] = 0
-                            update_data['sequence_last_switched'] = now
-                            update_data['time_string_last_result'] = None
-                        elif message['type'] == 'text':
-                            update_data['sequence_cur_pos'] = None
-                            update_data['sequence_last_switched'] = None
-                            if message['data'].get('parse_time_string', False):
-                                update_data['time_string_last_result'] = datetime.datetime.now().strftime(message['data']['text'])
-                            else:
-                                update_data['time_string_last_result'] = None
-                        elif message['type'] == 'bitmap':
-                            update_data['sequence_cur_pos'] = None
-                            update_data['sequence_last_switched'] = None
-                            update_data['time_string_last_result'] = None
-                    
-                    if message['type'] == 'sequence':
-                        actual_message = message['data'][update_data['sequence_cur_pos']]
-                        sequence_needs_switching = now - update_data['sequence_last_switched'] >= actual_message['duration']
-                    else:
-                        actual_message = message
-                        sequence_needs_switching = False
-                    
-                    if sequence_needs_switching:
-                        if update_data['sequence_cur_pos'] == len(message['data']) - 1:
-                            update_data['sequence_cur_pos'] = 0
-                        else:
-                            update_data['sequence_cur_pos'] += 1
-                        actual_message = message['data'][update_data['sequence_cur_pos']]
-                        update_data['sequence_last_switched'] = now
-                    
-                    if actual_message['type'] == 'text' and actual_message['data'].get('parse_time_string', False):
-                        time_string_cur_result = datetime.datetime.now().strftime(actual_message['data']['text'])
-                    
-                    needs_refresh = update_data['message_changed'] or \
-                                    actual_message['data'].get('parse_time_string', False) and \
-                                    time_string_cur_result != update_data['time_string_last_result'] or \
-                                    sequence_needs_switching
-                    
-                    if needs_refresh:
-                        if actual_message['type'] == 'bitmap':
-                            update_data['time_string_last_result'] = None
-                            self.set_bitmap(display, 
-                                            actual_message['data']['bitmap'],
-                                            actual_message['data'].get('blend_bitmap', False),
-                                            actual_message['data'].get('align'))
-                        elif actual_message['type'] == 'text':
-                            if actual_message['data'].get('parse_time_string', False):
-                                update_data['time_string_last_result'] = time_string_cur_result
-                                text = time_string_cur_result
-                            else:
-                                update_data['time_string_last_result'] = None
-                                text = actual_message['data']['text']
-                            
-                            bitmap = self.graphics.build_text(text,
-                                                              actual_message['data'].get('font', "Arial"),
-                                                              actual_message['data'].get('size', 11),
-                                                              actual_message['data'].get('align'))
-                            
-                            self.set_bitmap(display,
-                                            bitmap,
-                                            actual_message['data'].get('blend_bitmap', False))
-                        
-                        if sequence_needs_switching or update_data['message_changed']:
-                            # Reset config items that haven't been specifically set to their global values
-                            reset_keys = [key for key in update_data['config_specific'] if key not in actual_message.get('config', {})]
-                            for key in reset_keys:
-                                self.set_config(display, key, self.CURRENT_CONFIG[display][key])
-                                update_data['config_specific'].pop(key, None)
-                            
-                            # Set message-specific config
-                            for key, value in actual_message.get('config', {}).items():
-                                if update_data['config_specific'].get(key) == value:
-                                    continue
-                                self.set_config(display, key, value)
-                                update_data['config_specific'][key] = value
-                    update_data['message_changed'] = False
-                    
-                    self.select_display(display)
+                pending = [deadline for deadline in deadlines.values() if deadline is not None]
+                if pending:
+                    timeout = min(max(0.0, min(pending) - time.time()), MAX_IDLE_TIME)
+                else:
+                    timeout = MAX_IDLE_TIME
+                
+                try:
+                    bus.update_queue.get(timeout = timeout)
+                    # Several changes may have piled up, they're all handled in one go
+                    while True:
+                        bus.update_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                
+                # Render all displays that need it in the background and send each one as soon as it's ready,
+                # so the next frame is being rendered while the current one is on the wire
+                now = time.time()
+                renders = []
+                for display in bus.displays:
+                    state = self.displays[display]
+                    is_due = deadlines[display] is not None and deadlines[display] <= now
+                    if is_due or state.has_changes():
+                        renders.append((display, self.render_executor.submit(self.update_display, display)))
+                
+                for display, render in renders:
                     try:
-                        self.controller.commit()
-                    except MatrixError:
-                        self.controller.clear_queue()
-                time.sleep(0.25)
+                        deadlines[display] = render.result()
+                        self.commit_display(display)
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        traceback.print_exc()
+                        deadlines[display] = time.time() + RETRY_INTERVAL
             except KeyboardInterrupt:
                 self.stop()
             except:
                 traceback.print_exc()
     
+    def notify_update(self, display):
+        # Wake up the thread of the bus the display is on, or all of them if display is None
+        if display is None:
+            for bus in self.buses:
+                bus.update_queue.put(None)
+        else:
+            self.displays[display].bus.update_queue.put(display)
+    
+    def update_display(self, display):
+        """
+        Apply pending configuration and message changes to a display and prepare what has to be sent to it.
+        This runs on the render pool, the actual sending is up to commit_display.
+        Returns the time at which the display needs to be updated again, or None if it only changes on request.
+        """
+        
+        state = self.displays[display]
+        config, message, config_keys_changed, message_changed = state.take_changes()
+        try:
+            return self.refresh_display(display, config, message, config_keys_changed, message_changed)
+        except:
+            # The retry has to start over with these changes
+            state.restore_changes(config_keys_changed, message_changed)
+            raise
+    
+    def refresh_display(self, display, config, message, config_keys_changed, message_changed):
+        now = time.time()
+        state = self.displays[display]
+        
+        # Process configuration changes
+        for key in config_keys_changed:
+            self.set_config(display, key, config[key])
+            if key == 'power_state' and config[key]:
+                message_changed = True
+        
+        # A stream takes precedence over the regular message
+        streaming, stream_frame, stream_frames_skipped = state.take_stream_frame()
+        if streaming:
+            if stream_frame is not None and config['power_state']:
+                state.stats['frames_dropped'] += stream_frames_skipped
+                state.stats['frames_shown'] += 1
+                self.set_frame(display, stream_frame)
+            elif stream_frame is not None:
+                # Nothing is shown while the display is switched off
+                state.stats['frames_dropped'] += stream_frames_skipped + 1
+            return None
+        
+        if message is None or not config['power_state']:
+            return None
+        
+        if message_changed:
+            if message['type'] == 'sequence':
+                state.sequence_cur_pos = 0
+                state.sequence_last_switched = now
+                state.time_string_last_result = None
+            elif message['type'] == 'text':
+                state.sequence_cur_pos = None
+                state.sequence_last_switched = None
+                if message['data'].get('parse_time_string', False):
+                    state.time_string_last_result = datetime.datetime.now().strftime(message['data']['text'])
+                else:
+                    state.time_string_last_result = None
+            elif message['type'] in ('bitmap', 'animation'):
+                state.sequence_cur_pos = None
+                state.sequence_last_switched = None
+                state.time_string_last_result = None
+        
+        if message['type'] == 'sequence':
+            actual_message = message['data'][state.sequence_cur_pos]
+            sequence_needs_switching = now - state.sequence_last_switched >= actual_message['duration']
+        else:
+            actual_message = message
+            sequence_needs_switching = False
+        
+        if sequence_needs_switching:
+            # Stick to the schedule instead of adding up the delays of every wakeup, unless we're too far behind
+            switched_at = state.sequence_last_switched + actual_message['duration']
+            if state.sequence_cur_pos == len(message['data']) - 1:
+                state.sequence_cur_pos = 0
+            else:
+                state.sequence_cur_pos += 1
+            actual_message = message['data'][state.sequence_cur_pos]
+            state.sequence_last_switched = switched_at if now - switched_at < actual_message['duration'] else now
+        
+        if actual_message['type'] == 'text' and actual_message['data'].get('parse_time_string', False):
+            time_string_cur_result = datetime.datetime.now().strftime(actual_message['data']['text'])
+        
+        animation_next_change = None
+        if actual_message['type'] == 'animation':
+            if message_changed or sequence_needs_switching or state.animation is None:
+                state.animation = self.build_animation(display, actual_message)
+                state.animation_start = now
+                state.animation_position = None
+            animation_position, animation_frame, animation_next_change = state.animation.frame_at(now - state.animation_start)
+        else:
+            state.animation = None
+        
+        needs_refresh = message_changed or \
+                        actual_message['data'].get('parse_time_string', False) and \
+                        time_string_cur_result != state.time_string_last_result or \
+                        sequence_needs_switching or \
+                        state.animation is not None and animation_position != state.animation_position
+        
+        compiled_frame = None
+        if message['type'] == 'sequence' and state.compiled is not None and state.compiled[0] is message:
+            compiled_frame = state.compiled[1][state.sequence_cur_pos]
+        
+        if needs_refresh:
+            if compiled_frame is not None:
+                state.time_string_last_result = None
+                self.set_frame(display, *compiled_frame)
+            elif actual_message['type'] == 'animation':
+                state.time_string_last_result = None
+                # If we couldn't keep up with the frame rate, some frames have been skipped
+                if state.animation_position is not None and animation_position > state.animation_position + 1:
+                    state.stats['frames_dropped'] += animation_position - state.animation_position - 1
+                state.stats['frames_shown'] += 1
+                state.animation_position = animation_position
+                self.set_frame(display, animation_frame)
+            elif actual_message['type'] == 'bitmap':
+                state.time_string_last_result = None
+                self.set_bitmap(display, 
+                                decode_bitmap(actual_message['data']['bitmap']),
+                                actual_message['data'].get('blend_bitmap', False),
+                                actual_message['data'].get('align'))
+            elif actual_message['type'] == 'text':
+                if actual_message['data'].get('parse_time_string', False):
+                    state.time_string_last_result = time_string_cur_result
+                    text = time_string_cur_result
+                else:
+                    state.time_string_last_result = None
+                    text = actual_message['data']['text']
+                
+                font = actual_message['data'].get('font', "Arial")
+                size = actual_message['data'].get('size', 11)
+                align = actual_message['data'].get('align')
+                renderer = actual_message['data'].get('renderer', 'pil')
+                width = state.bus.controller.num_blocks * 8
+                if actual_message['data'].get('parse_time_string', False) and renderer == 'pil' and "@img:" not in text:
+                    # Clocks only change a few digits at a time, so don't render the whole text again
+                    bitmap, state.time_string_layout = self.graphics.build_time_text(text, font, size, align, state.time_string_layout, width)
+                else:
+                    bitmap = self.graphics.build_text_bitmap(text, font, size, align, renderer, width)
+                
+                self.set_bitmap(display,
+                                bitmap,
+                                actual_message['data'].get('blend_bitmap', False))
+            
+            if sequence_needs_switching or message_changed:
+                # Reset config items that haven't been specifically set to their global values
+                reset_keys = [key for key in state.config_specific if key not in actual_message.get('config', {})]
+                for key in reset_keys:
+                    self.set_config(display, key, config[key])
+                    state.config_specific.pop(key, None)
+                
+                # Set message-specific config
+                for key, value in actual_message.get('config', {}).items():
+                    if state.config_specific.get(key) == value:
+                        continue
+                    self.set_config(display, key, value)
+                    state.config_specific[key] = value
+        
+        # Work out when something is going to change next
+        deadline = None
+        if message['type'] == 'sequence':
+            deadline = state.sequence_last_switched + actual_message['duration']
+        if actual_message['data'].get('parse_time_string', False):
+            # Check again when the result can change next, at the start of the next second or minute
+            interval = time_string_interval(actual_message['data']['text'])
+            next_change = (math.floor(now / interval) + 1) * interval
+            deadline = next_change if deadline is None else min(deadline, next_change)
+        if animation_next_change is not None:
+            next_frame = state.animation_start + animation_next_change
+            deadline = next_frame if deadline is None else min(deadline, next_frame)
+        return deadline
+    
+    def build_animation(self, display, message):
+        # Render the source of an animation message and compute its frames
+        data = message['data']
+        width = self.displays[display].bus.controller.num_blocks * 8
+        if 'bitmap' in data:
+            bitmap = decode_bitmap(data['bitmap']).align(width, data.get('align'))
+        else:
+            bitmap = self.graphics.build_text_bitmap(data['text'], data.get('font', "Arial"), data.get('size', 11), data.get('align'), data.get('renderer', 'pil'), width)
+        
+        return MatrixAnimation.build(bitmap, data.get('effect', 'slide-up'), width, data.get('fps', 10), data.get('loop'), data.get('step', 1))
+    
+    def commit_display(self, display):
+        state = self.displays[display]
+        controller = state.bus.controller
+        outbox, state.outbox = state.outbox, []
+        for method, value in outbox:
+            try:
+                getattr(controller, method)(value)
+            except:
+                traceback.print_exc()
+                if method.startswith("set_"):
+                    state.sent_config.pop(method[4:], None)
+        
+        # Only talk to the display if there actually is something to send
+        if not controller.pending_messages:
+            return False
+        
+        self.select_display(display)
+        stats = state.stats
+        start_time = time.time()
+        try:
+            controller.commit()
+        except MatrixError:
+            controller.clear_queue()
+            # We don't know what the display has received, so send everything again next time
+            state.sent_frame = None
+            state.sent_config = {}
+            stats['failed_commits'] += 1
+            return False
+        else:
+            stats['commits'] += 1
+            return True
+        finally:
+            stats['io_time'] += time.time() - start_time
+    
     def process_message(self, message):
         success = True
         error = None
         
+        for display in message.get('displays') or []:
+            if not isinstance(display, int) or not 0 <= display < len(self.displays):
+                return {'success': False, 'error': "Invalid display: %s" % display}
+        
         if message['type'] == 'control':
-            for display in message.get('displays', []):
-                for key, value in message['message'].items():
-                    if key in self.CURRENT_CONFIG[display]:
-                        if self.CURRENT_CONFIG[display][key] != value:
-                            self.CURRENT_CONFIG[display][key] = value
-                            self.UPDATE_DATA[display]['config_keys_changed'].append(key)
-                    else:
-                        success = False
-                        error = "Invalid configuration option: %s" % key
-                        break
+            # Check everything first so an invalid option doesn't leave a change half applied
+            for key in message['message']:
+                if key not in DEFAULT_CONFIG:
+                    success = False
+                    error = "Invalid configuration option: %s" % key
+                    break
             if success:
+                for display in message.get('displays', []):
+                    if self.displays[display].update_config(message['message']):
+                        self.notify_update(display)
                 self.save_config()
             return {'success': success, 'error': error}
         elif message['type'] == 'data':
+            error = self.check_data_message(message['message'])
+            if error is not None:
+                return {'success': False, 'error': error}
+            
             for display in message.get('displays', []):
-                self.CURRENT_MESSAGE[display] = message['message']
-                self.UPDATE_DATA[display]['message_changed'] = True
+                self.displays[display].set_message(message['message'])
+                self.notify_update(display)
+                if message['message'] is not None and message['message']['type'] == 'sequence':
+                    self.compile_executor.submit(self.compile_message, display, message['message'])
             if success:
                 self.save_config()
             return {'success': success, 'error': error}
@@ -452,11 +1012,11 @@ class MatrixServer(object):
             displays = message.get('displays')
             keys = message.get('keys')
             if displays is None:
-                displays = (0, 1, 2, 3)
+                displays = range(len(self.displays))
             
             reply = {}
             for display in displays:
-                config = self.CURRENT_CONFIG[display]
+                config = self.displays[display].config
                 reply_config = {}
                 for key, value in config.items():
                     if keys is None or key in keys:
@@ -466,17 +1026,52 @@ class MatrixServer(object):
         elif message['type'] == 'query-message':
             displays = message.get('displays')
             if displays is None:
-                displays = (0, 1, 2, 3)
+                displays = range(len(self.displays))
             
-            reply = dict(((display, self.CURRENT_MESSAGE[display]) for display in displays))
+            reply = dict(((display, self.displays[display].message) for display in displays))
             return reply
         elif message['type'] == 'query-bitmap':
             displays = message.get('displays')
             if displays is None:
-                displays = (0, 1, 2, 3)
+                displays = range(len(self.displays))
             
-            reply = dict(((display, self.CURRENT_BITMAP[display]) for display in displays))
+            encoding = message.get('encoding', BITMAP_ENCODING_LIST)
+            if encoding not in BITMAP_ENCODINGS:
+                return {'success': False, 'error': "Invalid bitmap encoding: %s" % encoding}
+            
+            reply = {}
+            for display in displays:
+                bitmap = self.displays[display].bitmap
+                reply[display] = encode_bitmap(bitmap, encoding) if bitmap is not None else None
             return reply
+        elif message['type'] == 'query-stats':
+            displays = message.get('displays')
+            if displays is None:
+                displays = range(len(self.displays))
+            reset = message.get('reset', False)
+            
+            reply = {'displays': {}, 'buses': []}
+            reset_buses = []
+            for display in displays:
+                state = self.displays[display]
+                flow_control = state.bus.controller.get_flow_control(state.address)
+                reply['displays'][display] = dict(state.stats, bus = self.buses.index(state.bus),
+                                                  chunk_size = flow_control.chunk_size, chunk_delay = flow_control.chunk_delay)
+                if reset:
+                    state.reset_stats()
+                    reset_buses.append(state.bus)
+            for bus in self.buses:
+                # Only reset the counters of buses that the requested displays are on
+                reply['buses'].append(dict(bus.controller.get_stats(bus in reset_buses), displays = bus.displays))
+            return reply
+        elif message['type'] == 'query-capabilities':
+            return {
+                'framing': [FRAME_VERSION_LEGACY, FRAME_VERSION],
+                'bitmap_encodings': list(BITMAP_ENCODINGS),
+                'keep_alive': bool(self.keep_alive_timeout),
+                'stream': True,
+                'renderers': list(RENDERERS)
+            }
         else:
             success = False
             error = "Invalid message type: %s" % message.get('type')
@@ -485,40 +1080,186 @@ class MatrixServer(object):
         # This should never be called
         return {'success': success, 'error': error}
     
+    def check_data_message(self, message):
+        # Find problems with a data message before accepting it, they would only show up when it's displayed otherwise.
+        # Returns an error message or None.
+        if message is None:
+            return None
+        
+        try:
+            items = message['data'] if message['type'] == 'sequence' else [message]
+            for item in items:
+                data = item['data']
+                if item['type'] == 'bitmap' or item['type'] == 'animation' and 'bitmap' in data:
+                    try:
+                        decode_bitmap(data['bitmap'])
+                    except (KeyError, TypeError, ValueError) as exc:
+                        return "Invalid bitmap: %s" % exc
+                if item['type'] in ('text', 'animation') and data.get('renderer', 'pil') not in RENDERERS:
+                    return "Invalid renderer: %s" % data['renderer']
+                if item['type'] == 'animation':
+                    effect = data.get('effect', 'slide-up')
+                    fps = data.get('fps', 10)
+                    step = data.get('step', 1)
+                    if effect not in ANIMATION_EFFECTS:
+                        return "Invalid animation effect: %s" % effect
+                    # bool is a subclass of int, but true and false aren't frame rates
+                    if isinstance(fps, bool) or not isinstance(fps, (int, float)) or not 0 < fps < math.inf:
+                        return "Invalid animation fps: %s" % fps
+                    if isinstance(step, bool) or not isinstance(step, int) or step < 1:
+                        return "Invalid animation step: %s" % step
+                    # null picks the effect's default
+                    if data.get('loop') is not None and not isinstance(data['loop'], bool):
+                        return "Invalid animation loop: %s" % data['loop']
+                    if ('text' in data) == ('bitmap' in data):
+                        return "Animation needs either text or bitmap"
+                    if 'text' in data and not isinstance(data['text'], str):
+                        return "Invalid animation text: %s" % data['text']
+        except (KeyError, TypeError) as exc:
+            return "Invalid message: %s" % exc
+        return None
+    
+    def compile_message(self, display, message):
+        """
+        Render every item of a sequence in advance, so switching to it only means sending the result.
+        Items that depend on the time or on what's displayed before them (time strings and blending) are left out
+        and rendered when they're needed.
+        """
+        
+        state = self.displays[display]
+        width = state.bus.controller.num_blocks * 8
+        frames = []
+        try:
+            for item in message['data']:
+                data = item['data']
+                if data.get('blend_bitmap', False) or data.get('parse_time_string', False):
+                    frames.append(None)
+                    continue
+                
+                if item['type'] == 'text':
+                    bitmap = self.graphics.build_text_bitmap(data['text'], data.get('font', "Arial"), data.get('size', 11), data.get('align'), data.get('renderer', 'pil'), width)
+                elif item['type'] == 'bitmap':
+                    bitmap = decode_bitmap(data['bitmap']).align(width, data.get('align'))
+                else:
+                    frames.append(None)
+                    continue
+                frames.append((bitmap, MatrixController.build_bitmap_message(bitmap.blocks())))
+        except:
+            traceback.print_exc()
+            return
+        
+        # Only keep the result if the message hasn't been replaced in the meantime
+        with state.lock:
+            if state.message is message:
+                state.compiled = (message, frames)
+    
     def set_bitmap(self, display, bitmap, blend_bitmap = False, align = None):
-        new_bitmap = self.graphics.align_long_bitmap(bitmap, align)
-        if blend_bitmap:
-            resulting_bitmap = self.graphics.blend_long_bitmaps(self.CURRENT_BITMAP[display], new_bitmap)
+        state = self.displays[display]
+        controller = state.bus.controller
+        new_bitmap = MatrixBitmap.coerce(bitmap).align(controller.num_blocks * 8, align)
+        if blend_bitmap and state.bitmap is not None:
+            resulting_bitmap = self.graphics.blend_bitmaps(state.bitmap, new_bitmap)
         else:
             resulting_bitmap = new_bitmap
-        self.CURRENT_BITMAP[display] = resulting_bitmap
-        self.graphics.send_long_bitmap(resulting_bitmap)
+        return self.set_frame(display, resulting_bitmap)
+    
+    def set_frame(self, display, bitmap, message = None):
+        # Show a bitmap as it is. message is the bitmap message for the controller if it has already been built.
+        state = self.displays[display]
+        state.bitmap = bitmap
+        
+        frame = bitmap.pack()
+        if frame == state.sent_frame:
+            return False
+        if message is None:
+            state.outbox.append(('send_bitmap', bitmap.blocks()))
+        else:
+            state.outbox.append(('queue_message', message))
+        state.sent_frame = frame
+        return True
     
     def set_config(self, display, key, value):
-        try:
-            func = getattr(self.controller, "set_%s" % key)
-            func(value)
-        except:
-            traceback.print_exc()
+        state = self.displays[display]
+        if key in state.sent_config and state.sent_config[key] == value:
             return False
+        
+        state.outbox.append(("set_%s" % key, value))
+        state.sent_config[key] = value
         return True
 
 
 
+class MatrixStream(object):
+    """
+    A connection that frames are pushed through, see MatrixClient.stream.
+    Can be used as a context manager to end the stream automatically.
+    """
+    
+    def __init__(self, sock, framing):
+        self.sock = sock
+        self.framing = framing
+    
+    def send(self, bitmap):
+        # The bitmap can be a MatrixBitmap or a list of rows
+        send_message(self.sock, encode_bitmap(bitmap, BITMAP_ENCODING_PACKED), self.framing)
+    
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            send_message(self.sock, None, self.framing)
+        finally:
+            self.sock.close()
+            self.sock = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 class MatrixClient(object):
-    def __init__(self, host, port = 1810, timeout = 3.0):
+    def __init__(self, host, port = 1810, timeout = 3.0, keep_alive = False, framing = None, bitmap_encoding = None):
         self.host = host
         self.port = port
         self.timeout = timeout
+        # None means legacy framing, which every server understands, until the server has said it knows the current one
+        self.framing = framing
+        # None means the encoding is negotiated with the server when the first bitmap is sent, until then lists of rows are built
+        self.bitmap_encoding = bitmap_encoding
         self.queue = []
+        # In keep-alive mode, one connection is used for all messages and replies are matched by request ID
+        self.keep_alive = keep_alive
+        self.sock = None
+        self.next_request_id = 0
+        self.replies = {}
+        self.ignored_requests = set()
+    
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((self.host, self.port))
+        except:
+            sock.close()
+            raise
+        return sock
+    
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.replies = {}
+        self.ignored_requests = set()
     
     def send_raw_message(self, message, expect_reply = True):
+        if self.keep_alive:
+            return self.send_raw_messages([message], expect_reply)[0]
+        
         reply = None
+        sock = self.connect()
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
-            sock.connect((self.host, self.port))
-            send_message(sock, message)
+            send_message(sock, message, self.get_framing())
             
             if expect_reply:
                 reply = receive_message(sock)
@@ -526,11 +1267,135 @@ class MatrixClient(object):
             sock.close()
         return reply
     
+    def send_raw_messages(self, messages, expect_reply = True):
+        """
+        Send several messages over the persistent connection without waiting for each reply in between.
+        Returns the replies in the same order. Only available in keep-alive mode.
+        """
+        
+        if not self.keep_alive:
+            raise ValueError("Pipelining messages requires keep-alive mode")
+        
+        if self.sock is not None and self.idle_socket_closed():
+            self.close()
+        reused = self.sock is not None
+        try:
+            if self.sock is None:
+                self.sock = self.connect()
+            
+            request_ids = []
+            for message in messages:
+                try:
+                    request_ids.append(self.send_request(message))
+                except socket.error:
+                    # Only the first send on a reused connection is safe to repeat, nothing has reached the server before it
+                    if not reused or request_ids:
+                        raise
+                    self.close()
+                    self.sock = self.connect()
+                    reused = False
+                    request_ids.append(self.send_request(message))
+            
+            if not expect_reply:
+                self.ignored_requests.update(request_ids)
+                return [None] * len(request_ids)
+            return [self.receive_reply(request_id) for request_id in request_ids]
+        except:
+            # The server may have processed some of the requests, so they can't simply be sent again,
+            # and replies still on the way would get mixed up with later ones on this connection
+            self.close()
+            raise
+    
+    def idle_socket_closed(self):
+        # A server that closed the idle connection shows up as the end of the stream before anything was sent
+        readable, writable, errors = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.sock.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+    
+    def send_request(self, message):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        send_message(self.sock, {'request_id': request_id, 'messages': message}, self.get_framing())
+        return request_id
+    
+    def receive_reply(self, request_id):
+        while request_id not in self.replies:
+            envelope = receive_message(self.sock)
+            if envelope['request_id'] in self.ignored_requests:
+                self.ignored_requests.discard(envelope['request_id'])
+                continue
+            self.replies[envelope['request_id']] = envelope['reply']
+        return self.replies.pop(request_id)
+    
+    def stream(self, displays, align = None):
+        """
+        Open a stream to push frames to the given displays in real time. Only the latest frame is shown if they arrive
+        faster than the displays can be updated. Streamed frames aren't saved, the displays go back to their regular message
+        when the stream is closed.
+        """
+        
+        sock = self.connect()
+        try:
+            request = {'type': 'stream', 'displays': displays}
+            if align is not None:
+                request['align'] = align
+            send_message(sock, request, self.get_framing())
+            reply = receive_message(sock)
+            if not reply or not reply.get('success'):
+                raise ValueError("The server refused the stream: %s" % (reply.get('error') if reply else None))
+        except:
+            sock.close()
+            raise
+        
+        # Frames are never answered, so there's nothing to wait for
+        sock.settimeout(None)
+        return MatrixStream(sock, self.get_framing())
+    
+    def get_capabilities(self):
+        reply = self.send_raw_message(self.build_capabilities_query_message())
+        if 'success' in reply and not reply['success']:
+            # Servers that don't know this message type only support the basics
+            return {'framing': [FRAME_VERSION_LEGACY], 'bitmap_encodings': [BITMAP_ENCODING_LIST], 'keep_alive': False}
+        if self.framing is None and FRAME_VERSION in reply.get('framing', []):
+            self.framing = FRAME_VERSION
+        return reply
+    
+    def get_framing(self):
+        # Unlike the bitmap encoding, this doesn't ask the server by itself, that would cost an extra round trip for every client
+        if self.framing is None:
+            return FRAME_VERSION_LEGACY
+        return self.framing
+    
+    def get_bitmap_encoding(self):
+        # Asks the server the first time, so this is only used when actually sending something
+        if self.bitmap_encoding is None:
+            if BITMAP_ENCODING_PACKED in self.get_capabilities().get('bitmap_encodings', []):
+                self.bitmap_encoding = BITMAP_ENCODING_PACKED
+            else:
+                self.bitmap_encoding = BITMAP_ENCODING_LIST
+        return self.bitmap_encoding
+    
     def clear_queue(self):
         self.queue = []
     
+    def encode_queued_bitmaps(self):
+        # Bitmaps are built as lists of rows until the server has been asked whether it can take them packed
+        if self.bitmap_encoding is not None:
+            return
+        
+        bitmaps = [data for message in self.queue if message['type'] == 'data' for data in data_message_bitmaps(message['message'])]
+        if bitmaps and self.get_bitmap_encoding() != BITMAP_ENCODING_LIST:
+            for data in bitmaps:
+                if isinstance(data['bitmap'], list):
+                    data['bitmap'] = encode_bitmap(data['bitmap'], self.bitmap_encoding)
+    
     def commit(self):
         if self.queue:
+            self.encode_queued_bitmaps()
             reply = self.send_raw_message(self.queue)
             if reply.get('success'):
                 self.clear_queue()
@@ -550,17 +1415,48 @@ class MatrixClient(object):
     def build_message_query_message(self, displays):
         return {'type': 'query-message', 'displays': displays}
     
-    def build_bitmap_query_message(self, displays):
-        return {'type': 'query-bitmap', 'displays': displays}
+    def build_bitmap_query_message(self, displays, encoding = None):
+        message = {'type': 'query-bitmap', 'displays': displays}
+        if encoding is not None:
+            message['encoding'] = encoding
+        return message
+    
+    def build_stats_query_message(self, displays, reset = False):
+        message = {'type': 'query-stats', 'displays': displays}
+        if reset:
+            message['reset'] = True
+        return message
+    
+    def build_capabilities_query_message(self):
+        return {'type': 'query-capabilities'}
     
     def build_bitmap_message(self, bitmap, align = None, blend_bitmap = False, config = {}, duration = None):
+        # The bitmap can be a MatrixBitmap or a list of rows
+        bitmap = encode_bitmap(bitmap, self.bitmap_encoding or BITMAP_ENCODING_LIST)
         message = {'type': 'bitmap', 'config': config, 'data': {'align': align, 'blend_bitmap': blend_bitmap, 'bitmap': bitmap}}
         if duration:
             message['duration'] = duration
         return message
     
-    def build_text_message(self, text, font = "Arial", size = 11, align = None, parse_time_string = False, blend_bitmap = False, config = {}, duration = None):
+    def build_text_message(self, text, font = "Arial", size = 11, align = None, parse_time_string = False, blend_bitmap = False, config = {}, duration = None, renderer = None):
         message = {'type': 'text', 'config': config, 'data': {'align': align, 'font': font, 'size': size, 'parse_time_string': parse_time_string, 'blend_bitmap': blend_bitmap, 'text': text}}
+        if renderer is not None:
+            # Only sent if set, for servers that don't know about renderers
+            message['data']['renderer'] = renderer
+        if duration:
+            message['duration'] = duration
+        return message
+    
+    def build_animation_message(self, effect, text = None, bitmap = None, font = "Arial", size = 11, align = None, fps = 10, loop = None, step = 1, config = {}, duration = None, renderer = None):
+        # Either text or bitmap has to be given
+        data = {'effect': effect, 'align': align, 'fps': fps, 'loop': loop, 'step': step}
+        if bitmap is not None:
+            data['bitmap'] = encode_bitmap(bitmap, self.bitmap_encoding or BITMAP_ENCODING_LIST)
+        else:
+            data.update({'font': font, 'size': size, 'text': text})
+            if renderer is not None:
+                data['renderer'] = renderer
+        message = {'type': 'animation', 'config': config, 'data': data}
         if duration:
             message['duration'] = duration
         return message
@@ -588,15 +1484,22 @@ class MatrixClient(object):
     def send_message_query_message(self, displays):
         return self.send_raw_message(self.build_message_query_message(displays))
     
-    def send_bitmap_query_message(self, displays):
-        return self.send_raw_message(self.build_bitmap_query_message(displays))
+    def send_bitmap_query_message(self, displays, encoding = None):
+        return self.send_raw_message(self.build_bitmap_query_message(displays, encoding))
+    
+    def send_stats_query_message(self, displays, reset = False):
+        return self.send_raw_message(self.build_stats_query_message(displays, reset))
     
     def append_bitmap_message(self, displays, bitmap, align = None, blend_bitmap = False, config = {}):
         message = self.build_bitmap_message(bitmap, align, blend_bitmap, config)
         return self.append_data_message(displays, message)
     
-    def append_text_message(self, displays, text, font = "Arial", size = 11, align = None, parse_time_string = False, blend_bitmap = False, config = {}):
-        message = self.build_text_message(text, font, size, align, parse_time_string, blend_bitmap, config)
+    def append_text_message(self, displays, text, font = "Arial", size = 11, align = None, parse_time_string = False, blend_bitmap = False, config = {}, renderer = None):
+        message = self.build_text_message(text, font, size, align, parse_time_string, blend_bitmap, config, renderer = renderer)
+        return self.append_data_message(displays, message)
+    
+    def append_animation_message(self, displays, effect, text = None, bitmap = None, font = "Arial", size = 11, align = None, fps = 10, loop = None, step = 1, config = {}, renderer = None):
+        message = self.build_animation_message(effect, text, bitmap, font, size, align, fps, loop, step, config, renderer = renderer)
         return self.append_data_message(displays, message)
     
     def append_sequence_message(self, displays, sequence, duration = None):
@@ -610,7 +1513,19 @@ class MatrixClient(object):
         return self.send_message_query_message(displays)
     
     def get_bitmap(self, displays = None):
-        return self.send_bitmap_query_message(displays)
+        # Bitmaps are transferred packed if possible, but returned as lists of rows like before
+        encoding = self.get_bitmap_encoding()
+        reply = self.send_bitmap_query_message(displays, encoding if encoding != BITMAP_ENCODING_LIST else None)
+        if 'success' in reply:
+            # The server refused the query, pass the error on
+            return reply
+        for display, bitmap in reply.items():
+            if bitmap is not None:
+                reply[display] = decode_bitmap(bitmap).to_long_bitmap()
+        return reply
+    
+    def get_stats(self, displays = None, reset = False):
+        return self.send_stats_query_message(displays, reset)
     
     def set_config(self, displays, config):
         return self.append_control_message(displays, config)
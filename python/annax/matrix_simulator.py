@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# Copyright 2015 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This file contains a simulation of the matrix controller firmware (ANNAX_Matrix.ino) for testing without a display.
+Importing it registers the annax:// URL with pyserial, so it can be used like any serial port.
+MatrixController imports it by itself when it's given such a URL:
+    
+    MatrixController("annax://?poll_interval=0.005&error_rate=0.01")
+
+URL options:
+    timing          Whether to take as long as a real serial line at the configured baudrate (1 or 0, default 1)
+    blocks          The number of blocks of each display (default 15)
+    poll_interval   How long the firmware may be busy multiplexing before it notices incoming data, in seconds (default 0)
+    rx_buffer       The size of the firmware's receive buffer (default 64)
+    error_rate      The probability of each byte being corrupted on the way to the controller (default 0)
+    loss_rate       The probability of each byte getting lost on the way to the controller (default 0)
+    drop_rate       The probability of a response getting lost on the way back (default 0)
+    seed            Seed for the random number generator used for the above
+"""
+
+import random
+import serial
+import time
+import urllib.parse
+
+from collections import deque
+from serial.serialutil import SerialBase, SerialException
+try:
+    from serial.serialutil import PortNotOpenError
+except ImportError:
+    # Before pyserial 3.5, there only was a ready-made exception instance
+    from serial.serialutil import portNotOpenError as PortNotOpenError
+
+# These mirror the settings of the firmware
+NUM_BLOCKS = 15
+MAX_BLOCK_COUNT = 100
+SERIAL_READ_TIMEOUT = 1.0
+RX_BUFFER_SIZE = 64
+
+MSG_START = 0xFF
+MSG_BITMAP = 0xA0
+
+RESPONSE_SUCCESS = 0xFF
+ERR_INV_ACTION_BYTE = 0xE0
+ERR_INV_BLOCK_COUNT = 0xE1
+ERR_TIMEOUT = 0xE2
+ERR_INV_BITMAP_DATA = 0xE3
+ERR_INV_VALUE = 0xE4
+
+# The values the firmware accepts for each parameter, and what it starts out with
+PARAMETER_RANGES = {
+    0xA1: range(0, 3), # Display mode
+    0xA2: range(1, 256), # Scroll speed
+    0xA3: range(0, 2), # Scroll direction
+    0xA4: range(0, 3), # Scroll mode
+    0xA5: range(0, NUM_BLOCKS + 1), # Scroll gap
+    0xA6: range(0, 2), # Power state
+    0xA7: range(0, 256), # Blink frequency
+    0xA8: range(0, 2), # Stop indicator
+    0xA9: range(1, 256), # Scroll step
+    0xAA: range(0, 256) # Stop indicator blink frequency
+}
+
+DEFAULT_PARAMETERS = {
+    0xA1: 2,
+    0xA2: 1,
+    0xA3: 0,
+    0xA4: 1,
+    0xA5: 5,
+    0xA6: 0,
+    0xA7: 0,
+    0xA8: 0,
+    0xA9: 1,
+    0xAA: 0
+}
+
+class MatrixSimulator(object):
+    """
+    The receive state machine of a single display, fed one byte at a time.
+    Like the firmware, messages in a datagram take effect as they are received, even if a later one fails.
+    """
+    
+    def __init__(self, num_blocks = NUM_BLOCKS):
+        self.num_blocks = num_blocks
+        self.bitmap = [bytes(8)] * num_blocks
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        
+        # Whether a datagram has been started but not finished
+        self.receiving = False
+        self.datagrams_received = 0
+        self.bytes_received = 0
+        # Responses sent, by response byte
+        self.responses = {}
+        
+        self._receiver = self._receive()
+        next(self._receiver)
+    
+    def _receive(self):
+        # Mirrors doSerialCommunication(). Every yield waits for the next byte and can hand out a response.
+        response = None
+        while True:
+            byte = yield response
+            response = None
+            if byte != MSG_START:
+                # No error, just discard
+                continue
+            
+            self.receiving = True
+            num_msgs = yield
+            for n in range(num_msgs):
+                action = yield
+                if action == MSG_BITMAP:
+                    block_count = yield
+                    if not 0 < block_count <= MAX_BLOCK_COUNT:
+                        response = ERR_INV_BLOCK_COUNT
+                        break
+                    
+                    # The previous bitmap is cleared first, so it's lost if the transmission times out
+                    self.bitmap = [bytes(8)] * block_count
+                    data = bytearray()
+                    for i in range(block_count * 8):
+                        data.append((yield))
+                    self.bitmap = [bytes(data[pos:pos + 8]) for pos in range(0, len(data), 8)]
+                elif action in PARAMETER_RANGES:
+                    value = yield
+                    if value not in PARAMETER_RANGES[action]:
+                        response = ERR_INV_VALUE
+                        break
+                    self.parameters[action] = value
+                else:
+                    response = ERR_INV_ACTION_BYTE
+                    break
+            else:
+                self.datagrams_received += 1
+                response = RESPONSE_SUCCESS
+            
+            self.receiving = False
+            self.responses[response] = self.responses.get(response, 0) + 1
+    
+    def feed(self, byte):
+        # Returns the response byte if this byte finished a datagram
+        self.bytes_received += 1
+        return self._receiver.send(byte)
+    
+    def timeout(self):
+        # No data arrived for SERIAL_READ_TIMEOUT while in the middle of a datagram
+        self._receiver = self._receive()
+        next(self._receiver)
+        self.receiving = False
+        self.responses[ERR_TIMEOUT] = self.responses.get(ERR_TIMEOUT, 0) + 1
+        return ERR_TIMEOUT
+
+class SimulatorSerial(SerialBase):
+    """
+    A serial port with simulated matrix controllers on the other end, one for each combination of DTR and RTS
+    so the display multiplexer works as well. Bytes are processed at the moment they would have arrived.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        self.timing = True
+        self.num_blocks = NUM_BLOCKS
+        self.poll_interval = 0.0
+        self.rx_buffer_size = RX_BUFFER_SIZE
+        self.error_rate = 0.0
+        self.loss_rate = 0.0
+        self.drop_rate = 0.0
+        self.random = random.Random()
+        
+        # The simulated controllers by (DTR, RTS)
+        self.displays = {}
+        # Responses as (time of arrival, byte)
+        self._responses = deque()
+        # When the line is done transmitting everything written so far
+        self._line_free_at = 0.0
+        # When each controller last received a byte and when it is going to look at its receive buffer
+        self._last_arrival = {}
+        self._poll_at = {}
+        self._buffered = {}
+        self._discard_until = {}
+        super(SimulatorSerial, self).__init__(*args, **kwargs)
+    
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        
+        self.from_url(self._port)
+        self.is_open = True
+    
+    def close(self):
+        self.is_open = False
+    
+    def from_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "annax":
+            raise SerialException("Expected a URL in the form annax://[?option=value[&...]], got %s" % url)
+        
+        for option, values in urllib.parse.parse_qs(parts.query, True).items():
+            value = values[0]
+            if option == 'timing':
+                self.timing = value not in ('0', 'false', 'no')
+            elif option == 'blocks':
+                self.num_blocks = int(value)
+            elif option == 'poll_interval':
+                self.poll_interval = float(value)
+            elif option == 'rx_buffer':
+                self.rx_buffer_size = int(value)
+            elif option in ('error_rate', 'loss_rate', 'drop_rate'):
+                setattr(self, option, float(value))
+            elif option == 'seed':
+                self.random.seed(value)
+            else:
+                raise SerialException("Unknown option for annax:// URL: %s" % option)
+    
+    def _reconfigure_port(self):
+        pass
+    
+    def _update_dtr_state(self):
+        pass
+    
+    def _update_rts_state(self):
+        pass
+    
+    def _update_break_state(self):
+        pass
+    
+    @property
+    def byte_time(self):
+        return 10.0 / self._baudrate if self.timing else 0.0
+    
+    @property
+    def selected_display(self):
+        address = (bool(self._dtr_state), bool(self._rts_state))
+        if address not in self.displays:
+            self.displays[address] = MatrixSimulator(self.num_blocks)
+        return self.displays[address]
+    
+    def _respond(self, when, response):
+        if response is not None and self.random.random() >= self.drop_rate:
+            self._responses.append((when, response))
+    
+    def _check_timeouts(self, now):
+        # Let every controller that has been waiting for too long give up on its datagram
+        for address, display in self.displays.items():
+            if display.receiving and now - self._last_arrival[address] >= SERIAL_READ_TIMEOUT:
+                self._respond(self._last_arrival[address] + SERIAL_READ_TIMEOUT, display.timeout())
+    
+    def _next_timeout(self):
+        timeouts = [self._last_arrival[address] + SERIAL_READ_TIMEOUT for address, display in self.displays.items() if display.receiving]
+        return min(timeouts) if timeouts else None
+    
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError
+        
+        now = time.time()
+        display = self.selected_display
+        address = (bool(self._dtr_state), bool(self._rts_state))
+        arrival = max(now, self._line_free_at)
+        for byte in bytes(data):
+            arrival += self.byte_time
+            self._check_timeouts(arrival)
+            if self.random.random() < self.loss_rate:
+                continue
+            if self.random.random() < self.error_rate:
+                byte ^= 1 << self.random.randrange(8)
+            
+            # The controller clears its receive buffer after sending an error
+            if arrival <= self._discard_until.get(address, 0.0):
+                continue
+            
+            # While the controller is busy multiplexing, data piles up in its receive buffer and may overflow it
+            processed = arrival
+            if self.poll_interval:
+                poll_at = self._poll_at.get(address)
+                if not display.receiving and (poll_at is None or poll_at < arrival):
+                    poll_at = self._poll_at[address] = arrival + self.poll_interval
+                    self._buffered[address] = 0
+                if arrival < poll_at:
+                    self._buffered[address] += 1
+                    if self._buffered[address] > self.rx_buffer_size:
+                        continue
+                    processed = poll_at
+            
+            self._last_arrival[address] = processed
+            response = display.feed(byte)
+            if response is not None and response != RESPONSE_SUCCESS:
+                self._discard_until[address] = processed
+            self._respond(processed, response)
+        
+        self._line_free_at = arrival
+        return len(data)
+    
+    def read(self, size = 1):
+        if not self.is_open:
+            raise PortNotOpenError
+        
+        start = time.time()
+        deadline = start + self._timeout if self._timeout is not None else None
+        data = bytearray()
+        while len(data) < size:
+            # Find out what happens next: a response arriving or a controller timing out
+            next_timeout = self._next_timeout()
+            events = [when for when in (self._responses[0][0] if self._responses else None, next_timeout) if when is not None]
+            if not events or (deadline is not None and min(events) > deadline):
+                if deadline is not None and self.timing:
+                    time.sleep(max(0.0, deadline - time.time()))
+                break
+            
+            when = min(events)
+            if self.timing:
+                time.sleep(max(0.0, when - time.time()))
+            self._check_timeouts(when)
+            while self._responses and self._responses[0][0] <= when and len(data) < size:
+                data.append(self._responses.popleft()[1])
+        return bytes(data)
+    
+    @property
+    def in_waiting(self):
+        now = time.time()
+        return len([response for response in self._responses if response[0] <= now])
+    
+    def reset_input_buffer(self):
+        now = time.time()
+        while self._responses and self._responses[0][0] <= now:
+            self._responses.popleft()
+    
+    def reset_output_buffer(self):
+        pass
+
+if 'annax' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('annax')
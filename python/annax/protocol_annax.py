@@ -0,0 +1,8 @@
+# Copyright 2015 Julian Metzler
+
+"""
+This file makes the simulated matrix controller available to pyserial under the annax:// URL.
+pyserial looks for URL handlers in modules named protocol_<scheme>, see matrix_simulator.py.
+"""
+
+from .matrix_simulator import SimulatorSerial as Serial
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Copyright 2015 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This script measures the stages of getting a message onto a display (rendering, bitmap conversion,
+network framing, transmission) separately and end to end against a simulated controller.
+Results can be saved as a baseline and later runs compared against it:
+    
+    ./pipeline.py --save baseline.json
+    ./pipeline.py --compare baseline.json
+
+The suite is run several times in a row (rounds), so anything that slows the machine down for a while affects
+every benchmark a little instead of one of them a lot. Comparisons use the fastest sample of each benchmark, and
+how far the fastest samples of the rounds are apart is taken as its noise. A regression is only reported if
+a benchmark got slower by more than both the threshold and the noise of the baseline and the current run combined.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import timeit
+
+from PIL import Image
+
+from annax import MatrixController, MatrixGraphics, MatrixServer
+from annax.matrix_server import receive_message, send_message
+
+# Each sample runs a benchmark as often as it takes to fill this many seconds
+MIN_SAMPLE_TIME = 0.1
+
+# Slowdowns up to this fraction of the baseline are considered noise
+DEFAULT_THRESHOLD = 0.1
+
+# How long to wait for the server to send a message to the simulated display
+COMMIT_TIMEOUT = 5.0
+
+SERVER_BENCHMARK = "server/message_to_commit"
+
+LONG_TEXT = "Next stop: Central Station @img:<%s> Change here for all regional trains @img:<%s> " \
+            "Please mind the gap between the train and the platform edge @img:<%s> Thank you for travelling with us"
+
+class DummyController(object):
+    num_blocks = 15
+
+class TimedController(MatrixController):
+    # Lets the benchmark wait for a commit to finish
+    def __init__(self, *args, **kwargs):
+        MatrixController.__init__(self, *args, **kwargs)
+        self.committed = threading.Event()
+    
+    def commit(self):
+        result = MatrixController.commit(self)
+        self.committed.set()
+        return result
+
+def make_image(path):
+    image = Image.new('RGB', (12, 8), (0, 0, 0))
+    for x in range(12):
+        image.putpixel((x, x % 8), (255, 255, 255))
+    image.save(path)
+
+def graphics_benchmarks(graphics, font, temp_dir):
+    image_path = os.path.join(temp_dir, "arrow.png")
+    make_image(image_path)
+    long_text = LONG_TEXT % (image_path, image_path, image_path)
+    
+    short_image = graphics.align_image(graphics._prepare_text("12:34", font, 11), 'center')
+    long_bitmap = graphics.build_text(long_text, font, 11)
+    short_long_bitmap = graphics.build_text("12:34", font, 11)
+    overlay = graphics.build_text("!", font, 11, 'right')
+    
+    atlas = graphics.get_atlas(graphics.get_font(font), 11)
+    
+    # A seconds clock, where every call changes the last digit
+    clock = {'layout': None, 'counter': iter(range(10 ** 9))}
+    def build_clock():
+        text = "12:34:%02i" % (next(clock['counter']) % 60)
+        bitmap, clock['layout'] = graphics.build_time_text(text, font, 11, 'center', clock['layout'])
+        return bitmap
+    
+    return [
+        ("render/time_string", build_clock),
+        ("render/short_text", lambda: graphics._prepare_text("12:34", font, 11)),
+        ("render/long_text_with_images", lambda: graphics._prepare_text(long_text, font, 11)),
+        ("render/short_text_atlas", lambda: atlas.build("12:34")),
+        ("render/long_text_atlas", lambda: atlas.build(LONG_TEXT.replace("@img:<%s> ", ""))),
+        ("convert/image_to_short_bitmap", lambda: graphics.image_to_short_bitmap(short_image)),
+        ("convert/long_bitmap_to_short_bitmap", lambda: graphics.long_bitmap_to_short_bitmap(long_bitmap)),
+        ("bitmap/align_long_bitmap", lambda: graphics.align_long_bitmap(short_long_bitmap, 'center')),
+        ("bitmap/blend_long_bitmaps", lambda: graphics.blend_long_bitmaps(short_long_bitmap, overlay))
+    ]
+
+def framing_benchmarks(graphics, font):
+    sender, receiver = socket.socketpair()
+    text_message = {'type': 'data', 'displays': [0], 'message': {'type': 'text', 'data': {'text': "12:34", 'font': font, 'size': 11}}}
+    bitmap = graphics.build_text("Next stop: Central Station", font, 11)
+    bitmap_message = {'type': 'data', 'displays': [0], 'message': {'type': 'bitmap', 'data': {'bitmap': bitmap}}}
+    
+    def round_trip(message):
+        send_message(sender, message)
+        return receive_message(receiver)
+    
+    return [
+        ("framing/text_message", lambda: round_trip(text_message)),
+        ("framing/bitmap_message", lambda: round_trip(bitmap_message))
+    ]
+
+def server_benchmarks(font, baudrate, selected):
+    # A server with a single simulated display, updated with a different text every time so nothing is skipped.
+    # Only started if the benchmark is going to run.
+    if not selected(SERVER_BENCHMARK):
+        return []
+    
+    controller = TimedController("annax://", baudrate = baudrate)
+    server = MatrixServer(controller, port = 0, displays = [(controller, None)])
+    server.running = True
+    thread = threading.Thread(target = server.control_loop, args = (server.buses[0],), daemon = True)
+    thread.start()
+    
+    def process(message_type, message):
+        controller.committed.clear()
+        server.process_message({'type': message_type, 'displays': [0], 'message': message})
+        # A commit that never happens would otherwise be recorded as a very slow one
+        if not controller.committed.wait(COMMIT_TIMEOUT):
+            raise RuntimeError("The server didn't send anything to the display within %.1f seconds" % COMMIT_TIMEOUT)
+    
+    process('control', {'power_state': True})
+    counter = iter(range(10 ** 9))
+    return [
+        (SERVER_BENCHMARK, lambda: process('data', {'type': 'text', 'data': {'text': "%i" % next(counter), 'font': font, 'size': 11}}))
+    ]
+
+def calibrate(function):
+    # The number of calls it takes to fill a sample
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < MIN_SAMPLE_TIME:
+        number *= 2
+    return number
+
+def measure(function, repeat, number):
+    # Time per call of each sample
+    return [time / number for time in timeit.Timer(function).repeat(repeat, number)]
+
+def summarize(rounds, number):
+    """
+    Median and fastest time per call over all rounds, the spread between the fastest and slowest sample
+    relative to the median, and the noise: how far the fastest samples of the rounds are apart, relative to the fastest.
+    """
+    
+    samples = [sample for round_samples in rounds for sample in round_samples]
+    median = statistics.median(samples)
+    fastest = min(samples)
+    round_minimums = [min(round_samples) for round_samples in rounds]
+    return {
+        'median': median,
+        'min': fastest,
+        'spread': (max(samples) - fastest) / median,
+        'noise': (max(round_minimums) - fastest) / fastest,
+        'number': number
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark for the render, pack and transmit path")
+    parser.add_argument('-f', '--font', type = str, default = "PixelMix",
+        help = "The font to render with (Default: PixelMix)")
+    parser.add_argument('-n', '--repeat', type = int, default = 5,
+        help = "How many samples to take of each benchmark per round (Default: 5)")
+    parser.add_argument('-r', '--rounds', type = int, default = 3,
+        help = "How many times to run the whole suite. At least 2 are needed to tell how noisy the results are (Default: 3)")
+    parser.add_argument('-b', '--baudrate', type = int, default = 115200,
+        help = "The baudrate of the simulated controller (Default: 115200)")
+    parser.add_argument('-k', '--filter', type = str,
+        help = "Only run benchmarks whose name contains this string")
+    parser.add_argument('-s', '--save', type = str,
+        help = "Save the results to this file for later comparison")
+    parser.add_argument('-c', '--compare', type = str,
+        help = "Compare the results against a file saved with --save")
+    parser.add_argument('-t', '--threshold', type = float, default = DEFAULT_THRESHOLD,
+        help = "Report a regression if the fastest sample of a benchmark is slower than the baseline's by more than this fraction "
+        "and by more than the noise of both runs (Default: %.2f)" % DEFAULT_THRESHOLD)
+    
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    
+    temp_dir = tempfile.mkdtemp()
+    try:
+        selected = lambda name: not args.filter or args.filter in name
+        graphics = MatrixGraphics(DummyController())
+        benchmarks = graphics_benchmarks(graphics, args.font, temp_dir)
+        benchmarks += framing_benchmarks(graphics, args.font)
+        benchmarks += server_benchmarks(args.font, args.baudrate, selected)
+        benchmarks = [(name, function) for name, function in benchmarks if selected(name)]
+        
+        # Every round uses the same number of calls per sample, so the rounds can be compared
+        numbers = {name: calibrate(function) for name, function in benchmarks}
+        samples = {name: [] for name, function in benchmarks}
+        for round_number in range(args.rounds):
+            for name, function in benchmarks:
+                samples[name].append(measure(function, args.repeat, numbers[name]))
+        
+        results = {}
+        if baseline is None:
+            print("%-40s %12s %12s %8s %8s" % ("benchmark", "median (us)", "min (us)", "spread", "noise"))
+        else:
+            print("%-40s %12s %12s %8s %8s %9s" % ("benchmark", "median (us)", "min (us)", "spread", "noise", "change"))
+        
+        regressions = []
+        for name, function in benchmarks:
+            result = summarize(samples[name], numbers[name])
+            results[name] = result
+            line = "%-40s %12.1f %12.1f %7.1f%% %7.1f%%" % (name, result['median'] * 1e6, result['min'] * 1e6, result['spread'] * 100, result['noise'] * 100)
+            if baseline is not None and name in baseline:
+                # The fastest samples are the least disturbed by whatever else the machine is doing, and a change
+                # within the noise of both runs can't be told apart from it. Baselines saved before the noise
+                # was recorded fall back to their spread.
+                change = result['min'] / baseline[name]['min'] - 1
+                noise = baseline[name].get('noise', baseline[name]['spread']) + result['noise']
+                line += " %+8.1f%%" % (change * 100)
+                if change > max(args.threshold, noise):
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'repeat': args.repeat,
+                'rounds': args.rounds,
+                'results': results
+            }, f, indent = 4, sort_keys = True)
+    
+    if regressions:
+        print("%i benchmark(s) slower than the baseline beyond its noise and by more than %i%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
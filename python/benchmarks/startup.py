@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright 2015 Julian Metzler
+
+"""
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This script measures how long it takes to set up MatrixGraphics and resolve the first font,
+once without the font index, once with an empty index (cold start) and once with a valid index (warm start).
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from annax import MatrixGraphics
+
+class DummyController(object):
+    num_blocks = 15
+
+def measure(font, font_index_file):
+    start = time.perf_counter()
+    graphics = MatrixGraphics(DummyController(), font_index_file = font_index_file)
+    constructed = time.perf_counter()
+    graphics.get_font(font)
+    resolved = time.perf_counter()
+    return constructed - start, resolved - start
+
+def main():
+    parser = argparse.ArgumentParser(description = "Startup time benchmark for MatrixGraphics")
+    parser.add_argument('-f', '--font', type = str, default = "PixelMix",
+        help = "The font to resolve after construction (Default: PixelMix)")
+    parser.add_argument('-n', '--repeat', type = int, default = 5,
+        help = "How often to repeat each measurement (Default: 5)")
+    
+    args = parser.parse_args()
+    temp_dir = tempfile.mkdtemp()
+    index_file = os.path.join(temp_dir, "font_index.json")
+    
+    try:
+        results = {'no index': [], 'cold index': [], 'warm index': []}
+        for n in range(args.repeat):
+            results['no index'].append(measure(args.font, None))
+            if os.path.exists(index_file):
+                os.remove(index_file)
+            results['cold index'].append(measure(args.font, index_file))
+            results['warm index'].append(measure(args.font, index_file))
+    finally:
+        shutil.rmtree(temp_dir)
+    
+    print("%-12s %18s %18s" % ("", "construct (ms)", "first font (ms)"))
+    for name in ('no index', 'cold index', 'warm index'):
+        construct = min(result[0] for result in results[name]) * 1000
+        first_font = min(result[1] for result in results[name]) * 1000
+        print("%-12s %18.3f %18.3f" % (name, construct, first_font))
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,7 @@ Sequence messages are not supported from the command line. (It's just too bloody
 import argparse
 
 from annax import MatrixController, MatrixError, MatrixGraphics, MatrixClient
+from annax.matrix_graphics import RENDERERS
 
 def main():
     parser = argparse.ArgumentParser(description = "Command-line control script for a matrix controller")
@@ -54,6 +55,8 @@ def main():
         help = "The font size to use for rendering text (Default: 11)")
     parser.add_argument('-a', '--align', type = str, choices = ('left', 'center', 'right'), default = None,
         help = "How to align the text or image (useful only in static display mode)")
+    parser.add_argument('-r', '--renderer', type = str, choices = RENDERERS, default = None,
+        help = "How to render the text: as a whole with PIL, or from pre-rendered glyphs with proportional or fixed advance (Default: pil)")
     
     parser.add_argument('-pt', '--parse-time-string', action = 'store_true',
         help = "Treat the text message as a time format string (Only in server mode)")
@@ -101,7 +104,7 @@ def main():
             graphics.send_image(args.image, align = args.align)
         elif args.text is not None:
             graphics = MatrixGraphics(controller)
-            graphics.send_text(args.text, font = args.font, size = args.font_size, align = args.align)
+            graphics.send_text(args.text, font = args.font, size = args.font_size, align = args.align, renderer = args.renderer or 'pil')
         
         if args.display_mode is not None:
             controller.set_display_mode(args.display_mode)
@@ -140,7 +143,7 @@ def main():
         if args.image is not None:
             print("Image sending via server is not yet supported.")
         elif args.text is not None:
-            client.append_text_message(args.displays, args.text, args.font, args.font_size, args.align, args.parse_time_string, args.blend_bitmap)
+            client.append_text_message(args.displays, args.text, args.font, args.font_size, args.align, args.parse_time_string, args.blend_bitmap, renderer = args.renderer)
         
         if args.display_mode is not None:
             client.set_display_mode(args.displays, args.display_mode)
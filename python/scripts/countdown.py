@@ -59,7 +59,7 @@ def main():
     if not args.displays:
         print("Warning: No displays selected.")
 
-    client = MatrixClient(args.server, port = args.port)
+    client = MatrixClient(args.server, port = args.port, keep_alive = True)
     target = datetime.datetime.strptime(args.target, DATETIME_FORMAT)
     previous_countdown = ""
 
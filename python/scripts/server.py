@@ -2,13 +2,17 @@
 
 import argparse
 from annax import MatrixController, MatrixServer
+from annax.matrix_controller import DEFAULT_TIMEOUT, DEFAULT_TUNING_TIMEOUT
+from annax.matrix_server import CONFIG_FILE
 
 def main():
     parser = argparse.ArgumentParser(description = "Command-line control script for a matrix controller")
-    parser.add_argument('-sp', '--serial-port', type = str, required = True,
-        help = "The serial port to use for communication with the matrix controller")
+    parser.add_argument('-sp', '--serial-port', type = str, required = True, action = 'append',
+        help = "The serial port to use for communication with the matrix controller. Can be given multiple times to drive several controllers in parallel. Use annax:// for a simulated controller.")
     parser.add_argument('-b', '--baudrate', type = int, default = 115200,
         help = "The baudrate to use for communication with the matrix controller (Default: 115200)")
+    parser.add_argument('-t', '--timeout', type = float,
+        help = "The number of seconds to wait for a response from the matrix controller (Default: %.1f, or %.1f without automatic tuning)" % (DEFAULT_TUNING_TIMEOUT, DEFAULT_TIMEOUT))
     parser.add_argument('-p', '--port', type = int, default = 1810,
         help = "The port for the server to listen on (Default: 1810)")
     parser.add_argument('-d', '--debug', action = 'store_true',
@@ -17,10 +21,31 @@ def main():
         help = "Enable debug output of serial communication")
     parser.add_argument('-ip', '--allowed-ips', type = str,
         help = "A string that each ip that wants to connect has to begin with")
+    parser.add_argument('-cs', '--chunk-size', type = int,
+        help = "The number of bytes to send to the matrix controller at once (Default: tuned automatically)")
+    parser.add_argument('-cy', '--chunk-delay', type = float,
+        help = "The number of seconds to wait between two chunks (Default: tuned automatically)")
+    parser.add_argument('-nt', '--no-auto-tune', action = 'store_true',
+        help = "Keep chunk size and delay fixed instead of adapting them to transmission errors")
+    parser.add_argument('-nd', '--num-displays', type = int, choices = range(1, 5), default = 4,
+        help = "The number of displays connected to each controller, 1 to 4 (Default: 4)")
+    parser.add_argument('-rt', '--render-threads', type = int, default = 2,
+        help = "The number of threads used to render frames while others are being sent (Default: 2)")
+    parser.add_argument('-ka', '--keep-alive-timeout', type = float, default = 60.0,
+        help = "Seconds an idle connection is kept open for further messages, 0 closes it after the first reply (Default: 60)")
+    parser.add_argument('-tc', '--text-cache-size', type = int, default = 64,
+        help = "The number of rendered texts to keep in memory (Default: 64)")
+    parser.add_argument('-cf', '--config-file', type = str, default = CONFIG_FILE,
+        help = "The file to save the configuration and messages of the displays to (Default: %s)" % CONFIG_FILE)
     
     args = parser.parse_args()
-    controller = MatrixController(args.serial_port, baudrate = args.baudrate, debug = args.controller_debug)
-    server = MatrixServer(controller, port = args.port, allowed_ip_match = args.allowed_ips, debug = args.debug)
+    displays = []
+    for serial_port in args.serial_port:
+        controller = MatrixController(serial_port, baudrate = args.baudrate, timeout = args.timeout, chunk_size = args.chunk_size, chunk_delay = args.chunk_delay,
+                                      auto_tune = not args.no_auto_tune, debug = args.controller_debug)
+        displays.extend((controller, address) for address in range(args.num_displays))
+    server = MatrixServer(None, port = args.port, allowed_ip_match = args.allowed_ips, text_cache_size = args.text_cache_size, config_file = args.config_file, displays = displays, render_threads = args.render_threads,
+                          keep_alive_timeout = args.keep_alive_timeout, debug = args.debug)
     server.run()
 
 if __name__ == "__main__":